@@ -9,10 +9,12 @@ nothing fancy just basic testing of server's speed
 import random
 from mongoUtils.client import muClient
 from mongoUtils.aggregation import Aggregation
-from mongoUtils.helpers import muDatabase, muCollection
+from mongoUtils.helpers import muDatabase, muCollection, SONDot, LazySONDot
 from pymongo.read_preferences import ReadPreference
 from pymongo.write_concern import WriteConcern
 from datetime import datetime
+from time import time
+from bson import BSON, SON, CodecOptions
 from Hellas.Sparta import DotDot 
 from pprint import pprint
 
@@ -71,4 +73,28 @@ class muBMClient(muClient):
         return calcs, coll
  
  
- 
\ No newline at end of file
+ 
+
+
+def bm_document_classes(count=100000, fields=50, read_fields=None, verbose=True):
+    """decodes same raw message of fields fields count times into each document class and reads read_fields
+    (a list of field names defaults to first and last field) no server needed,
+    shows what lazy decoding saves when consumers read a few fields of large documents
+    """
+    doc = SON([('f_' + str(i), {'n': i, 's': 'x' * 20}) if i % 5 == 0 else ('f_' + str(i), 'x' * 20)
+               for i in range(0, fields)])
+    raw = BSON.encode(doc)
+    keys = read_fields or ['f_0', 'f_' + str(fields - 1)]
+    calcs = DotDot()
+    for document_class in (dict, SON, SONDot, LazySONDot):
+        opts = CodecOptions(document_class=document_class)
+        ts_start = time()
+        for i in range(count):
+            d = BSON(raw).decode(opts) if document_class is not LazySONDot else LazySONDot(raw, opts)
+            for k in keys:
+                d[k]
+        seconds = time() - ts_start
+        calcs[document_class.__name__] = {'seconds': seconds, 'docs_per_sec': int(count / seconds)}
+    if verbose:
+        pprint(calcs)
+    return calcs
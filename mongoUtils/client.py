@@ -1,7 +1,7 @@
 """ MongoDB client"""
 from pymongo import MongoClient
 from pymongo.errors import ConfigurationError
-from mongoUtils.helpers import (muDatabase, pp_doc, client_schema)
+from mongoUtils.helpers import (muDatabase, pp_doc, client_schema, client_inventory)
 from Hellas.Sparta import DotDot
 
 
@@ -34,9 +34,17 @@ class muClient(MongoClient):
                 raise
         self.cl_init_complete()
 
-    def cl_colstats(self, details=2, verbose=True):
+    def cl_colstats(self, details=2, verbose=True, fast=False, workers=16, cache_ttl=0):
+        """collections statistics of all databases
+        if fast statistics are fetched concurrently see :func:`~mongoUtils.helpers.client_inventory`
+        """
+        if fast:
+            rt = client_inventory(self, stats=True, workers=workers, cache_ttl=cache_ttl)
+            pp_doc(rt['dbs'], sort_keys=False, verbose=verbose)
+            return rt
         rt = DotDot([[d, self[d].collstats(details, False)] for d in self.database_names()])
         pp_doc(rt, sort_keys=False, verbose=verbose)
+        return rt
 
     def cl_schema(self, details=1, verbose=True):
         return client_schema(self, details, verbose)
@@ -1,21 +1,45 @@
 """some helper functions and classes"""
 
 import logging
-from datetime import datetime, date
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+from datetime import datetime, date, timedelta
+from time import sleep, time
+from itertools import islice
+from struct import pack, Struct
+from operator import getitem
+try:
+    from queue import Queue
+except ImportError:  # python 2
+    from Queue import Queue
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from Hellas.Sparta import DotDot, seconds_to_DHMS
 from Hellas.Thebes import Progress
-from bson import json_util, SON
+from bson import json_util, SON, CodecOptions, BSON
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.errors import InvalidBSON
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
 from mongoUtils import _PATH_TO_JS
 from pymongo.read_preferences import ReadPreference
 from pymongo.collection import Collection
 from pymongo.database import Database
-from pymongo import ReturnDocument
-from pymongo.bulk import BulkOperationBuilder
+from pymongo import ReturnDocument, InsertOne, ReplaceOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo.errors import (BulkWriteError, AutoReconnect, ExecutionTimeout, NetworkTimeout, WTimeoutError,
+                            WriteConcernError)
+from pymongo.write_concern import WriteConcern
 
 LOG = logging.getLogger(__name__)
 LOG.debug("loading module: " + __name__)
 
+np = None  # reserved to import numpy on demand
+
 
 class MongoUtilsError(Exception):
     """Base class for all MongoUtils exceptions."""
@@ -66,7 +90,55 @@ def coll_range(coll_obj, field_name="_id"):
         return None, None
 
 
-def coll_chunks(collection, field_name="_id", chunk_size=100000):
+def coll_chunks_bounds(collection, field_name="_id", chunk_size=100000, method='sample', tolerance=0.1):
+    """approximate chunk upper boundaries of a field without walking chunk_size index keys per chunk
+    boundaries are approximate so resulting chunks will contain roughly (not exactly) chunk_size documents
+
+    :Parameters:
+        - collection: (obj) a pymongo collection instance
+        - field_name: (str) see :func:`coll_chunks`
+        - chunk_size: (int) requested number of documents in each chunk
+        - method: (str) one of:
+            - 'sample': a $sample of (chunks / tolerance ** 2) documents (up to 10000 per chunk)
+              sorted client side, one round-trip
+            - 'bucketAuto': a $bucketAuto aggregation, one round-trip but a full scan on server
+            - 'splitVector': mongoDB splitVector command (field must be indexed, not available on mongos)
+        - tolerance: (float) on 'sample' method the approximate deviation of chunk sizes as a fraction of chunk_size
+          i.e 0.1 means each chunk is expected within about +- 10% of chunk_size (smaller values = bigger sample)
+          since with k sampled values per chunk sizes deviate by about 1/sqrt(k)
+    :Returns:
+        - a sorted list of distinct boundary values (excluding field's maximum value)
+    """
+    doc_count = collection.count()                          # from metadata when no filter
+    chunks_cnt = int(doc_count / chunk_size) if chunk_size > 0 else 0
+    if chunks_cnt < 2:
+        return []
+    if method == 'sample':
+        per_chunk = min(10000, max(1, int(round(1.0 / tolerance ** 2))))
+        size = min(doc_count, chunks_cnt * per_chunk)
+        pipeline = [{'$sample': {'size': size}}, {'$project': {'_id': 0, 'v': '$' + field_name}}]
+        values = sorted([d['v'] for d in collection.aggregate(pipeline, allowDiskUse=True) if 'v' in d])
+        if len(values) < chunks_cnt:        # i.e. most documents are missing field
+            return []
+        step = len(values) / float(chunks_cnt)
+        bounds = [values[int(step * i) - 1] for i in range(1, chunks_cnt)]
+    elif method == 'bucketAuto':
+        pipeline = [{'$bucketAuto': {'groupBy': '$' + field_name, 'buckets': chunks_cnt}}]
+        bounds = [d['_id']['max'] for d in collection.aggregate(pipeline, allowDiskUse=True)][:-1]
+    elif method == 'splitVector':
+        rt = collection.database.client.admin.command('splitVector', collection.full_name, keyPattern={field_name: 1},
+                                                      maxChunkObjects=chunk_size, maxChunkSizeBytes=2 ** 40)
+        bounds = [d[field_name] for d in rt['splitKeys']]
+    else:
+        raise ValueError("method must be one of 'sample', 'bucketAuto', 'splitVector'")
+    rt = []
+    for b in bounds:                                        # sorted so just skip duplicates
+        if not rt or b > rt[-1]:
+            rt.append(b)
+    return rt
+
+
+def coll_chunks(collection, field_name="_id", chunk_size=100000, method='skip', tolerance=0.1):
     """Provides an iterator with range query arguments for scanning a collection in batches equals to chunk_size
     for optimization reasons first chunk size is chunk_size +1
     similar to undocumented mongoDB splitVector command try it in mongo console:
@@ -81,6 +153,11 @@ def coll_chunks(collection, field_name="_id", chunk_size=100000):
         -  chunk_size: (int or float)  (defaults to 100000)
             - if int requested  number of documents in each chunk
             - if float (< 1.0) percent of total documents in collection i.e if 0.2 means 20%
+        - method: (str) how to find chunk boundaries (defaults to 'skip')
+            - 'skip': exact chunk sizes, each boundary costs a skip of chunk_size index keys on server
+            - 'sample', 'bucketAuto', 'splitVector': approximate chunk sizes planned upfront
+              see :func:`coll_chunks_bounds`
+        - tolerance: (float) see :func:`coll_chunks_bounds` (only used when method is 'sample')
     :Returns:
         - an iterator with a tuple (chunk number, query specification dictionary for each chunk)
 
@@ -96,6 +173,16 @@ def coll_chunks(collection, field_name="_id", chunk_size=100000):
     if isinstance(chunk_size, float) and chunk_size < 1:
         chunk_size = int(collection.count() * chunk_size)
     idMin, idMax = coll_range(collection, field_name)
+    if method != 'skip':
+        if idMin is None:
+            return
+        bounds = [b for b in coll_chunks_bounds(collection, field_name, chunk_size, method, tolerance)
+                  if idMin <= b < idMax] + [idMax]
+        curMin = idMin
+        for cntChunk, curMax in enumerate(bounds):
+            yield cntChunk, {field_name: {"$gte" if cntChunk == 0 else "$gt": curMin, "$lte": curMax}}
+            curMin = curMax
+        return
     curMin = idMin
     curMax = idMax
     cntChunk = 0
@@ -109,6 +196,146 @@ def coll_chunks(collection, field_name="_id", chunk_size=100000):
         curMin = curMax
 
 
+def _chunk_run(func, collection, chunk_num, query, retries=2, retry_sleep=1, pass_chunk_num=False):
+    """runs func(collection, query) (or func(collection, query, chunk_num) if pass_chunk_num) on a chunk
+    retrying on failure
+
+    :Returns: a tuple (chunk number, True|False success, result or last Exception)
+    """
+    tries = 0
+    while True:
+        try:
+            args = (collection, query, chunk_num) if pass_chunk_num else (collection, query)
+            return chunk_num, True, func(*args)
+        except Exception as e:
+            tries += 1
+            if tries > retries:
+                LOG.exception("chunk {} failed after {} tries query:{}".format(chunk_num, tries, query))
+                return chunk_num, False, e
+            LOG.warning("chunk {} retry {} of {} error:{}".format(chunk_num, tries, retries, e))
+            sleep(retry_sleep * tries)
+
+
+_PROCESS_CLIENTS = {}  # one client per worker process and connection string
+
+
+def _chunk_run_process(args):
+    """process pool entry point, collections can't be pickled so we get a fresh one in each process"""
+    func, connection_str, db_name, coll_name, chunk_num, query, retries, retry_sleep, pass_chunk_num = args
+    client = _PROCESS_CLIENTS.get(connection_str)
+    if client is None:
+        from pymongo import MongoClient
+        client = _PROCESS_CLIENTS[connection_str] = MongoClient(connection_str, connect=False)
+    return _chunk_run(func, client[db_name][coll_name], chunk_num, query, retries, retry_sleep, pass_chunk_num)
+
+
+def coll_connection_str(collection):
+    """a connection string to collection's server(s) (without credentials) useful when we need a new client
+    i.e. in a child process
+    """
+    nodes = collection.database.client.nodes or [collection.database.client.address]
+    return "mongodb://" + ",".join(["{}:{}".format(*n) for n in nodes])
+
+
+def coll_parallel_scan(collection, func, field_name="_id", chunk_size=100000, workers=4, mode='thread',
+                       method='skip', merge_func=None, merge_init=None, retries=2, retry_sleep=1, connection_str=None,
+                       chunks=None, pass_chunk_num=False, verbose=True):
+    """scans a collection in parallel by feeding range queries from :func:`coll_chunks` to a pool of workers
+
+    :Parameters:
+        - collection: (obj) a pymongo collection instance
+        - func: a function func(collection, query) to apply on each chunk, it should do its own find(query)
+          and return a result for the chunk (or None), on mode 'process' func and its results must be picklable
+          i.e. a module level function
+        - field_name: (str) see :func:`coll_chunks`
+        - chunk_size: (int or float) see :func:`coll_chunks`
+        - workers: (int) number of workers (defaults to 4)
+        - mode: (str) 'thread' or 'process' (defaults to 'thread') use process for cpu bound functions
+        - method: (str) chunk planning method see :func:`coll_chunks` (defaults to 'skip')
+        - merge_func: (optional) a function merge_func(accumulated, chunk_result) to merge chunk results
+          as they arrive (in completion order), if None results are returned as a list sorted by chunk number
+        - merge_init: initial accumulated value passed to merge_func (defaults to None)
+        - retries: (int) number of retries for a failed chunk before it is reported as failed (defaults to 2)
+        - retry_sleep: (int or float) seconds to sleep between retries (multiplied by retry number)
+        - connection_str: (str) connection string used by workers on 'process' mode
+          defaults to :func:`coll_connection_str` (so provide it if server requires authentication)
+        - chunks: (optional) an iterable of (chunk number, query) to use instead of :func:`coll_chunks`
+        - pass_chunk_num: (bool) if True func is called as func(collection, query, chunk number) (defaults to False)
+        - verbose: (bool) prints progress if True
+
+    :Returns: a DotDot with keys:
+        - results: list of chunk results sorted by chunk number or merge_func's result
+        - chunks: number of chunks processed
+        - failed: dictionary {chunk number: Exception} for chunks that failed after retries
+        - seconds: elapsed seconds
+
+    :Example:
+        >>> def cnt(coll, query): return coll.find(query).count()
+        >>> coll_parallel_scan(db.muTest_tweets, cnt, chunk_size=100, merge_func=lambda x, y: x + y, merge_init=0)
+        {'chunks': 10, 'failed': {}, 'results': 1000, 'seconds': 0.051}
+    """
+    if mode not in ('thread', 'process'):
+        raise ValueError("mode must be one of 'thread' or 'process'")
+    if chunks is None:
+        chunks = coll_chunks(collection, field_name, chunk_size, method=method)
+    res = DotDot({'chunks': 0})
+    failed = {}
+    results = merge_init if merge_func is not None else {}
+    ts_start = time()
+    if mode == 'thread':
+        pool = ThreadPool(workers)
+        jobs = pool.imap_unordered(lambda c: _chunk_run(func, collection, c[0], c[1], retries, retry_sleep,
+                                                        pass_chunk_num), chunks)
+    else:
+        if connection_str is None:
+            connection_str = coll_connection_str(collection)
+        specs = (func, connection_str, collection.database.name, collection.name)
+        pool = Pool(workers)
+        jobs = pool.imap_unordered(_chunk_run_process, (specs + (c[0], c[1], retries, retry_sleep, pass_chunk_num)
+                                                         for c in chunks))
+    try:
+        for chunk_num, success, result in jobs:
+            res.chunks += 1
+            if not success:
+                failed[chunk_num] = result
+            elif merge_func is not None:
+                results = merge_func(results, result)
+            else:
+                results[chunk_num] = result
+            if verbose:
+                print("chunk:{:8,d} done:{:8,d} failed:{:6,d}".format(chunk_num, res.chunks, len(failed)))
+    except BaseException:       # i.e. a merge_func error or KeyboardInterrupt, don't wait for queued chunks
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    res.failed = failed
+    res.results = results if merge_func is not None else [results[k] for k in sorted(results)]
+    res.seconds = time() - ts_start
+    return res
+
+
+def coll_track_field_suggest(coll_obj, capped=None):
+    """suggests a field with monotonic increasing values i.e. to follow new documents
+
+    :Parameters:
+        - coll_obj: a pymongo collection
+        - capped: (bool) if collection is capped if None it is checked
+    :Returns: 'ts' for capped collections with a ts field (i.e. oplog), '_id' if it is an ObjectId
+              or None if collection is empty or no such field can be found
+    """
+    doc_first = coll_obj.find_one()
+    if doc_first is None:
+        return None
+    if capped is None:
+        capped = coll_obj.options().get('capped')
+    if capped is True and 'ts' in doc_first.keys():
+        return 'ts'
+    if isinstance(doc_first['_id'], ObjectId):
+        return '_id'
+    return None
+
+
 def coll_update_id(coll_obj, doc, new_id):
     """updates a document's id by inserting a new doc then removing old one
 
@@ -138,8 +365,64 @@ def coll_update_id(coll_obj, doc, new_id):
             return False, False, False
 
 
+def _coll_copy_chunk(collObjFrom, collObjTarget, query, write_options, ae_n=1000, ignore_dups=False):
+    """copies documents matching query with its own unordered bulk writer, returns number of documents copied"""
+    bulk = muBulkOps(collObjTarget, ordered=False, ae_n=ae_n, dwc=write_options, ignore_dups=ignore_dups)
+    cnt = 0
+    for doc in collObjFrom.find(query):
+        bulk.insert(doc)
+        cnt += 1
+    bulk.execute_if_pending()
+    return cnt
+
+
+def _bulk_error_dups_only(bulk_write_error):
+    """True if a BulkWriteError is caused by duplicate key errors only"""
+    details = bulk_write_error.details
+    return not details.get('writeConcernErrors') and all([err['code'] == 11000 for err in details['writeErrors']])
+
+
+def _raw_batches(cursor, batch_bytes=2 ** 24):
+    """groups a cursor of RawBSONDocument into lists of up to ~batch_bytes encoded bytes without decoding them"""
+    batch, size = [], 0
+    for doc in cursor:
+        batch.append(doc)
+        size += len(doc.raw)
+        if size >= batch_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def _raw_insert(collObjTarget, batch, ignore_dups=False):
+    """unordered insert of a list of RawBSONDocument (bytes are sent as they are)"""
+    try:
+        return collObjTarget.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        if not ignore_dups or not _bulk_error_dups_only(e):
+            raise
+        return e.details
+
+
+def _coll_copy_raw_chunk(collObjFrom, collObjTarget, query, batch_bytes=2 ** 24, ignore_dups=False):
+    """same as :func:`_coll_copy_chunk` but collObjFrom must use a RawBSONDocument document_class and
+    collObjTarget a write concern"""
+    cnt = 0
+    for batch in _raw_batches(collObjFrom.find(query), batch_bytes):
+        _raw_insert(collObjTarget, batch, ignore_dups)
+        cnt += len(batch)
+    return cnt
+
+
+def _coll_copy_checkpoint_name(collObjFrom, collObjTarget):
+    return "coll_copy|{}|{}".format(collObjFrom.full_name, collObjTarget.full_name)
+
+
 def coll_copy(collObjFrom, collObjTarget, filter_dict=None,
-              create_indexes=False, dropTarget=False, write_options={'w': "majority"}, verbose=10):
+              create_indexes=False, dropTarget=False, write_options={'w': "majority"}, verbose=10,
+              workers=0, chunk_size=100000, method='sample', checkpoint=False, resume=False,
+              raw=False, batch_bytes=2 ** 24, return_results=False):
     """copies a collection using unordered bulk inserts
     similar to `copyTo <http://docs.mongodb.org/manual/reference/method/db.collection.copyTo/>`_ that is now deprecated
 
@@ -151,57 +434,298 @@ def coll_copy(collObjFrom, collObjTarget, filter_dict=None,
         - dropTarget: drop target collection before copy if True (other wise appends to it)
         - write_options: operation options (use {'w': 0} for none critical copies
         - verbose: if > 0 prints progress statistics at verbose percent intervals
+        - workers: (int) if > 1 copies in parallel that many chunks of _id ranges each one with its own reader
+          and unordered bulk writer (see :func:`coll_parallel_scan`) (defaults to 0 for a single stream copy)
+        - chunk_size: (int or float) chunk size when workers > 1 see :func:`coll_chunks`
+        - method: (str) chunks planning method when workers > 1 see :func:`coll_chunks` (defaults to 'sample')
+        - checkpoint: (bool) if True records progress in an :class:`AuxTools` collection on target's client
+          (last written _id or completed chunks when workers > 1) so an interrupted copy can be resumed
+        - resume: (bool) if True continues from last checkpoint of a previous copy between same collections
+          (target is not dropped), documents of the boundary batch that were already written are skipped as duplicates
+          when a previous copy was completed nothing is copied
+        - raw: (bool) if True documents are read as `RawBSONDocument` and their bytes are written back as they are
+          with no decoding/encoding to python objects (much less cpu on a plain copy) (defaults to False)
+        - batch_bytes: (int) maximum encoded size of each insert batch when raw is True (defaults to 16MB)
+        - return_results: (bool) return copy results instead of collObjTarget (defaults to False)
+    :Returns: collObjTarget or if return_results a DotDot with keys:
+        - documents: number of documents copied
+        - seconds: elapsed seconds
+        - indexes: :func:`coll_indexes_copy` results if create_indexes
     """
+    ts_start = time()
+    res_copy = DotDot({'documents': 0, 'seconds': 0})
     frmt_stats = "copying {:6.2f}% done  documents={:22,d} of {:22,d}"
     if verbose > 0:
         print("copy_collection:{}.{} to ==> {}.{}".format(collObjFrom.database.name, collObjFrom.name, collObjTarget.database.name, collObjTarget.name))
-    if dropTarget:
+    aux_tools = cp_name = cp = None
+    if checkpoint or resume:
+        aux_tools = AuxTools(client=collObjTarget.database.client)
+        cp_name = _coll_copy_checkpoint_name(collObjFrom, collObjTarget)
+        cp = aux_tools.checkpoint_get(cp_name) if resume else None
+        if cp is None:
+            aux_tools.checkpoint_reset(cp_name)
+        elif cp.get('done'):
+            if verbose > 0:
+                print("copy_collection: already completed nothing to resume")
+            return res_copy if return_results else collObjTarget
+    if dropTarget and cp is None:
         collObjTarget.drop()
-    docs = collObjFrom.find(filter_dict)
+    if raw:
+        collObjSource = collObjFrom.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        collObjWrite = collObjTarget.with_options(write_concern=WriteConcern(**write_options)) if write_options \
+            else collObjTarget
+    else:
+        collObjSource = collObjFrom
+    docs = collObjSource.find(filter_dict)
     totalRecords = collObjFrom.count() if filter_dict is None else docs.count()
     if verbose > 0:
         print("totalRecords", totalRecords)
-    perc_done_last = -1
-    bulk = muBulkOps(collObjTarget, ordered=False, ae_n=1000, dwc=write_options)
-    cnt = 0
-    for doc in docs:
-        cnt += 1
-        if verbose > 0:
-            perc_done = round((cnt + 1.0) / totalRecords, 3) * 100
-            if perc_done != perc_done_last and perc_done % verbose == 0:
-                print(frmt_stats.format(perc_done, cnt, totalRecords))
-                perc_done_last = perc_done
-        bulk.insert(doc)
-    bulk.execute_if_pending()
-    if create_indexes:
-        for k, v in list(collObjFrom.index_information().items()):
-            if k != "_id_":
-                idx = (v['key'][0])
+    if workers > 1:
+        def copy_chunk(coll, query, chunk_num):
+            if filter_dict:
+                query = {'$and': [filter_dict, query]}
+            # chunks are disjoint _id ranges, duplicates can only come from a previous try of same chunk
+            if raw:
+                rt = _coll_copy_raw_chunk(coll, collObjWrite, query, batch_bytes, ignore_dups=True)
+            else:
+                rt = _coll_copy_chunk(coll, collObjTarget, query, write_options, ignore_dups=True)
+            if aux_tools is not None:
+                aux_tools.checkpoint_add(cp_name, 'chunks_done', chunk_num)
+            return rt
+
+        def merge(cnt, cnt_chunk):
+            cnt += cnt_chunk
+            if verbose > 0:
+                print(frmt_stats.format(100.0 * cnt / max(totalRecords, 1), cnt, totalRecords))
+            return cnt
+        if cp is not None and cp.get('chunks'):
+            chunks = [(i, {'_id': {'$gte' if i == 0 else '$gt': c[0], '$lte': c[1]}})
+                      for i, c in enumerate(cp['chunks']) if i not in cp.get('chunks_done', [])]
+        else:
+            chunks = list(coll_chunks(collObjFrom, '_id', chunk_size, method=method))
+            if aux_tools is not None:  # chunks may not be reproducible (i.e. sampled) so we keep them
+                aux_tools.checkpoint_set(cp_name, chunks=[[q['_id'].get('$gte', q['_id'].get('$gt')), q['_id']['$lte']]
+                                                          for _, q in chunks])
+        res = coll_parallel_scan(collObjSource, copy_chunk, merge_func=merge, merge_init=0, workers=workers,
+                                 chunks=chunks, pass_chunk_num=True, verbose=False)
+        if res.failed:
+            raise MongoUtilsError("coll_copy failed on chunks {}".format(sorted(res.failed.keys())))
+        res_copy.documents = res.results
+    else:
+        if aux_tools is not None:           # we need a predictable order to know where we are
+            if cp is not None and 'last_id' in cp:
+                last_id_query = {'_id': {'$gt': cp['last_id']}}
+                docs = collObjSource.find({'$and': [filter_dict, last_id_query]} if filter_dict else last_id_query)
+            docs = docs.sort([('_id', 1)])
+        if raw:
+            cnt = 0
+            for batch in _raw_batches(docs, batch_bytes):
+                _raw_insert(collObjWrite, batch, ignore_dups=cp is not None)
+                cnt += len(batch)
+                if aux_tools is not None:
+                    aux_tools.checkpoint_set(cp_name, last_id=batch[-1]['_id'])
                 if verbose > 0:
-                    print("creating index {:s}".format(k))
-                collObjTarget.create_index([idx], backgound=True)
+                    print(frmt_stats.format(100.0 * cnt / max(totalRecords, 1), cnt, totalRecords))
+            res_copy.documents = cnt
+        else:
+            perc_done_last = -1
+            bulk = muBulkOps(collObjTarget, ordered=False, ae_n=1000, dwc=write_options, ignore_dups=cp is not None,
+                             async_n=0 if aux_tools is not None else 1)  # checkpoints need to know what is written
+            cnt = 0
+            for doc in docs:
+                cnt += 1
+                if verbose > 0:
+                    perc_done = round((cnt + 1.0) / totalRecords, 3) * 100
+                    if perc_done != perc_done_last and perc_done % verbose == 0:
+                        print(frmt_stats.format(perc_done, cnt, totalRecords))
+                        perc_done_last = perc_done
+                bulk.insert(doc)
+                if aux_tools is not None and bulk.cnt_operations_pending == 0:  # just executed
+                    aux_tools.checkpoint_set(cp_name, last_id=doc['_id'])
+            bulk.close()
+            res_copy.documents = cnt
+    if create_indexes:
+        res_copy.indexes = coll_indexes_copy(collObjFrom, collObjTarget, verbose=verbose > 0)
+    if aux_tools is not None:
+        aux_tools.checkpoint_set(cp_name, done=True)
+    if return_results:
+        res_copy.seconds = time() - ts_start
+        return res_copy
     return collObjTarget
 
 
-def coll_transform(coll, query={}, func=lambda x, y: x, verbose=True, **kwargs):
+def coll_indexes_copy(collObjFrom, collObjTarget, together=True, verbose=True):
+    """replicates all indexes of a collection (except _id) to an other collection with all their options
+    (compound keys, unique, sparse, partialFilterExpression, expireAfterSeconds etc.)
+    call it after a bulk load, building indexes on a loaded collection is much cheaper than maintaining them while loading
+
+    :Parameters:
+        - collObjFrom: collection to read indexes from
+        - collObjTarget: collection to create indexes to
+        - together: (bool) if True (default) builds all indexes by a single createIndexes command
+          (a single collection scan) otherwise builds them one by one
+        - verbose: (bool) prints build times if True
+    :Returns: a DotDot with keys:
+        - seconds: total build seconds
+        - indexes: {index name: build seconds} when together is True all indexes were built
+          in same pass so they all get the total build time
+    """
+    specs = []
+    for name, info in collObjFrom.index_information().items():
+        if name != "_id_":
+            spec = {k: v for k, v in info.items() if k not in ('v', 'ns', 'key')}
+            spec.update({'name': name, 'key': SON(info['key'])})
+            specs.append(spec)
+    res = DotDot({'seconds': 0, 'indexes': {}})
+    indexes = {}
+    batches = [specs] if together else [[spec] for spec in specs]
+    for batch in batches:
+        if not batch:
+            continue
+        ts_start = time()
+        collObjTarget.database.command('createIndexes', collObjTarget.name, indexes=batch)
+        seconds = time() - ts_start
+        res.seconds += seconds
+        for spec in batch:
+            indexes[spec['name']] = seconds
+            if verbose:
+                print("index created {:s} in {:,.2f} seconds".format(spec['name'], seconds))
+    res.indexes = indexes
+    return res
+
+
+def doc_diff(doc_old, doc_new, prefix=''):
+    """field level differences between two versions of a document useful for partial updates
+    nested documents are compared recursively, arrays and other values as a whole (type sensitive so 1 != 1.0)
+
+    :Parameters:
+        - doc_old: (dict) original document
+        - doc_new: (dict) modified document
+        - prefix: (str) used internally for nested fields
+    :Returns: a tuple ($set dictionary, $unset dictionary) with dot notation keys both empty if no differences
+    :Example:
+        >>> doc_diff({'_id': 1, 'a': 1, 'b': {'c': 1, 'd': 2}}, {'_id': 1, 'a': 1, 'b': {'c': 2}, 'e': 3})
+        ({'b.c': 2, 'e': 3}, {'b.d': ''})
+    """
+    set_dict, unset_dict = {}, {}
+    for k, v in doc_new.items():
+        if prefix == '' and k == '_id':
+            continue
+        if k not in doc_old:
+            set_dict[prefix + k] = v
+            continue
+        v_old = doc_old[k]
+        if isinstance(v, dict) and isinstance(v_old, dict) and v and v_old:
+            set_sub, unset_sub = doc_diff(v_old, v, prefix + k + '.')
+            set_dict.update(set_sub)
+            unset_dict.update(unset_sub)
+        elif type(v) is not type(v_old) or v != v_old:
+            set_dict[prefix + k] = v
+    for k in doc_old:
+        if k not in doc_new and not (prefix == '' and k == '_id'):
+            unset_dict[prefix + k] = ''
+    return set_dict, unset_dict
+
+
+def coll_transform(coll, query={}, func=lambda x, y: x, verbose=True, bulk_n=0, bulk_bytes=0, projection=None,
+                   diff=False, incremental=False, track_field=None, bulk_retries=0, on_error=None, **kwargs):
     """ transforms collection's documents by applying function func to (doc, collection) func should either return a document or None
+
+    :Parameters:
+        - coll: a pymongo collection
+        - query: (dict) a pymongo query to select documents to transform
+        - func: a function func(doc, collection) returning the transformed document or None to skip it
+        - verbose: (bool) prints progress if True
+        - bulk_n: (int) if > 0 writes are queued in an unordered :class:`muBulkOps` executed every bulk_n operations
+          instead of one round-trip per document (defaults to 0)
+        - bulk_bytes: (int) if > 0 (and bulk_n > 0) a bulk write is also executed when encoded size of queued
+          operations exceeds bulk_bytes (defaults to 0 for :data:`BULK_MAX_BYTES`)
+        - bulk_retries: (int) see retries of :class:`muBulkOps` (defaults to 0)
+        - on_error: (function) see :class:`muBulkOps` if given failed bulk writes are reported to it
+          and counted as failed instead of raising BulkWriteError (defaults to None)
+        - projection: (dict or list) fetch only those fields, transformed documents are then written by
+          $set of returned fields instead of replacing whole document (defaults to None)
+        - diff: (bool) if True only changed fields are written by $set/$unset updates (see :func:`doc_diff`)
+          and documents func didn't change are skipped, it costs a deep copy of each document (defaults to False)
+        - incremental: (bool) if True only documents with track_field value past the watermark of previous
+          incremental run are transformed, the watermark is kept per collection in an :class:`AuxTools` collection
+          (func should not modify track_field) (defaults to False)
+        - track_field: (str) a first level field with monotonic increasing values used when incremental
+          (see :class:`~pubsub.Sub`) if None it is suggested by :func:`coll_track_field_suggest`
+        - kwargs: extra arguments to replace_one/update_one (i.e upsert, bypass_document_validation)
+          when bulk_n > 0 bypass_document_validation goes to :class:`muBulkOps` and the rest to each operation
+    :Returns: a DotDot with total, transformed, unchanged and failed counts
     """
-    finds = coll.find(query)
+    bulk = None
+    if bulk_n > 0:
+        bulk = muBulkOps(coll, ordered=False, ae_n=bulk_n, ae_b=bulk_bytes or BULK_MAX_BYTES, retries=bulk_retries,
+                         on_error=on_error, bypass_document_validation=kwargs.pop('bypass_document_validation', False))
+    writer = bulk if bulk is not None else coll
+    if incremental:
+        if track_field is None:
+            track_field = coll_track_field_suggest(coll)
+            if track_field is None and coll.find_one() is None:
+                return DotDot({'total': 0, 'transformed': 0, 'unchanged': 0, 'failed': 0})
+        if track_field is None or track_field.find('.') > -1:
+            raise MongoUtilsError('no track_field or track_field is not first level')
+        aux_tools = AuxTools(client=coll.database.client)
+        wm_name = "coll_transform|{}".format(coll.full_name)
+        wm = aux_tools.checkpoint_get(wm_name)
+        if wm is not None:
+            wm_query = {track_field: {'$gt': wm['watermark']}}
+            query = {'$and': [query, wm_query]} if query else wm_query
+        if isinstance(projection, (list, tuple)):
+            projection = {i: 1 for i in projection}
+        if projection is not None:          # a copy, caller's projection is left as is
+            projection = dict(projection)
+            if any([v for k, v in projection.items() if k != '_id']):   # inclusion
+                projection[track_field] = 1
+            else:                           # exclusion, don't exclude track_field
+                projection.pop(track_field, None)
+        finds = coll.find(query, projection=projection, sort=[(track_field, 1)])
+        wm_val = None
+    else:
+        finds = coll.find(query, projection=projection)
 
     max_count = coll.count() if query == {} else None
-    counter = DotDot({'total': 0, 'transformed': 0})
+    counter = DotDot({'total': 0, 'transformed': 0, 'unchanged': 0, 'failed': 0})
     if verbose:
         head_line = "transforming db:'{}' collection:'{}'".format(coll.database.name, coll.name)
         progress = Progress(max_count=max_count, head_line=head_line,
                             extra_frmt='{total:12,d}|{transformed:12,d}|', extra_dict=counter, every_seconds=30, every_mod=None)
     for doc in finds:
         counter.total += 1
+        _id = doc['_id']
+        if incremental:
+            wm_val = doc[track_field]
+        doc_old = deepcopy(doc) if diff else None       # func may modify doc in place
         new_doc = func(doc, coll)
+        if new_doc and diff:
+            set_dict, unset_dict = doc_diff(doc_old, new_doc)
+            if not set_dict and not unset_dict:
+                counter.unchanged += 1
+                new_doc = None
         if new_doc:
             counter.transformed += 1
-            coll.replace_one({'_id': doc['_id']}, doc, **kwargs)
+            if diff:
+                update = {'$set': set_dict} if set_dict else {}
+                if unset_dict:
+                    update['$unset'] = unset_dict
+                writer.update_one({'_id': _id}, update, **kwargs)
+            elif projection is None:
+                writer.replace_one({'_id': _id}, new_doc, **kwargs)
+            else:
+                writer.update_one({'_id': _id}, {'$set': {k: v for k, v in new_doc.items() if k != '_id'}}, **kwargs)
+            if incremental and bulk is not None and bulk.cnt_operations_pending == 0:  # all up to here are written
+                aux_tools.checkpoint_set(wm_name, watermark=wm_val)
         if verbose and counter.total % 100 == 0:
             progress.progress(100, counter)
+    if bulk is not None:
+        bulk.close()
+        counter.failed = bulk.cnt_failed
+        counter.transformed -= bulk.cnt_failed
+    if incremental and wm_val is not None:
+        aux_tools.checkpoint_set(wm_name, watermark=wm_val)
     if verbose:
         progress.print_end(counter)
     return counter
@@ -228,23 +752,129 @@ def coll_validation_set(db, collection_name, validator=None, validationLevel="mo
     return db[collection_name]
 
 
-def db_transform(db, query={}, func=lambda x, y: x, **kwargs):
+def colls_schedule(collections, func, workers=4, max_per_db=None, largest_first=True, verbose=True):
+    """runs func(collection) for a number of collections concurrently on a bounded pool of threads
+
+    :Parameters:
+        - collections: (list) pymongo collections (may belong to different databases)
+        - func: a function func(collection) returning a result
+        - workers: (int) maximum number of collections processed concurrently (defaults to 4)
+        - max_per_db: (int) maximum number of collections of same database processed concurrently (defaults to None no limit)
+        - largest_first: (bool) if True collections are scheduled in descending order of data size so big ones
+          don't end up running alone at the end (defaults to True)
+        - verbose: (bool) prints timings if True
+    :Returns: a DotDot {database name: {collection name: DotDot with keys result, seconds, error}}
+              error is the Exception raised by func or None
+    """
+    def coll_size(coll):
+        try:
+            return col_stats(coll, indexDetails=False, scale=1).get('size', 0)
+        except Exception:                           # i.e. views
+            return 0
+    pending = sorted(collections, key=coll_size, reverse=True) if largest_first else list(collections)
+    running = {}
+    cond = threading.Condition()
+    res = DotDot()
+    frmt = "|{:>32s}|{:>32s}|seconds:{:12,.2f}|{}|"
+
+    def next_coll():
+        with cond:
+            while pending:
+                for coll in pending:
+                    if max_per_db is None or running.get(coll.database.name, 0) < max_per_db:
+                        pending.remove(coll)
+                        running[coll.database.name] = running.get(coll.database.name, 0) + 1
+                        return coll
+                cond.wait()
+            return None
+
+    def worker():
+        coll = next_coll()
+        while coll is not None:
+            ts_start = time()
+            coll_res = DotDot({'result': None, 'error': None})
+            try:
+                coll_res.result = func(coll)
+            except Exception as e:
+                LOG.exception("colls_schedule {} failed".format(coll.full_name))
+                coll_res.error = e
+            coll_res.seconds = time() - ts_start
+            with cond:
+                res.setdefault(coll.database.name, DotDot())[coll.name] = coll_res
+                running[coll.database.name] -= 1
+                cond.notify_all()
+            if verbose:
+                print(frmt.format(coll.database.name, coll.name, coll_res.seconds, "failed" if coll_res.error else "done"))
+            coll = next_coll()
+
+    threads = [threading.Thread(target=worker, name="colls_schedule_{}".format(i)) for i in range(max(1, workers))]
+    for thr in threads:
+        thr.daemon = True
+        thr.start()
+    for thr in threads:
+        thr.join()
+    return res
+
+
+def _colls_schedule_raise(res):
+    failed = ["{}.{}".format(db_name, col_name) for db_name, cols in res.items()
+              for col_name, col_res in cols.items() if col_res['error'] is not None]
+    if failed:
+        raise MongoUtilsError("failed on collections {}".format(sorted(failed)))
+
+
+def db_transform(db, query={}, func=lambda x, y: x, coll_workers=0, max_per_db=None, **kwargs):
+    """calls :func:`coll_transform` for all collections of a database
+
+    :Parameters:
+        - coll_workers: (int) if > 1 transforms that many collections concurrently, largest first,
+          and adds the elapsed seconds to each collection's results (see :func:`colls_schedule`)
+        - max_per_db: (int) see :func:`colls_schedule`
+        - for other parameters see :func:`coll_transform`
+    """
     res = DotDot()
+    if coll_workers > 1:
+        sched = colls_schedule([db[col_name] for col_name in db.collection_names()],
+                               lambda coll: coll_transform(coll, query=query, func=func, **kwargs),
+                               workers=coll_workers, max_per_db=max_per_db, verbose=kwargs.get('verbose', True))
+        _colls_schedule_raise(sched)
+        for col_name, col_res in sched.get(db.name, {}).items():
+            res[col_name] = col_res['result']
+            res[col_name]['seconds'] = col_res['seconds']
+        return res
     for col_name in db.collection_names():
-        res[col_name] = coll_transform(db[col_name], query={}, func=func, **kwargs)
+        res[col_name] = coll_transform(db[col_name], query=query, func=func, **kwargs)
     return res
 
 
-def client_transform(mongo_client, query={}, func=lambda x, y: x, exclude_dbs=['test', 'local', 'admin'], **kwargs):
+def client_transform(mongo_client, query={}, func=lambda x, y: x, exclude_dbs=['test', 'local', 'admin'],
+                     coll_workers=0, max_per_db=None, **kwargs):
+    """calls :func:`db_transform` for all databases of a client except exclude_dbs
+    if coll_workers > 1 collections of all databases are scheduled together (see :func:`db_transform`)
+    """
     res = DotDot()
-    for db_name in mongo_client.database_names():
-        if db_name not in exclude_dbs:
-            res[db_name] = db_transform(mongo_client[db_name], query={}, func=func, **kwargs)
+    db_names = [db_name for db_name in mongo_client.database_names() if db_name not in exclude_dbs]
+    if coll_workers > 1:
+        sched = colls_schedule([mongo_client[db_name][col_name] for db_name in db_names
+                                for col_name in mongo_client[db_name].collection_names()],
+                               lambda coll: coll_transform(coll, query=query, func=func, **kwargs),
+                               workers=coll_workers, max_per_db=max_per_db, verbose=kwargs.get('verbose', True))
+        _colls_schedule_raise(sched)
+        for db_name, cols in sched.items():
+            res[db_name] = DotDot()
+            for col_name, col_res in cols.items():
+                res[db_name][col_name] = col_res['result']
+                res[db_name][col_name]['seconds'] = col_res['seconds']
+        return res
+    for db_name in db_names:
+        res[db_name] = db_transform(mongo_client[db_name], query=query, func=func, **kwargs)
     return res
 
 
 def db_copy(dbObjFrom, dbObjTarget, col_name_prefix='',
-            create_indexes=True, dropTarget_collections=False, write_options={'w': "majority"}, verbose=10):
+            create_indexes=True, dropTarget_collections=False, write_options={'w': "majority"}, verbose=10,
+            workers=0, chunk_size=100000, checkpoint=False, resume=False, raw=False, index_workers=0,
+            coll_workers=0, max_per_db=None, return_results=False):
     """copies a db by calling coll_copy for all its collections
     useful becouse shell command doesn't work properly for protected dbs
 
@@ -256,12 +886,50 @@ def db_copy(dbObjFrom, dbObjTarget, col_name_prefix='',
         - dropTarget_collections: drop target collections before copy if True (other wise appends to it)
         - write_options: operation options (use {'w': 0} for none critical copies
         - verbose: if > 0 prints progress statistics at verbose percent intervals
+        - workers: (int) parallel streams for each collection see :func:`coll_copy`
+        - chunk_size: (int or float) see :func:`coll_copy`
+        - checkpoint: (bool) keep progress of each collection copy see :func:`coll_copy`
+        - resume: (bool) resume an interrupted db_copy, completed collections are skipped see :func:`coll_copy`
+        - raw: (bool) copy raw BSON bytes without decoding documents see :func:`coll_copy`
+        - index_workers: (int) if > 1 indexes are built (after all collections are copied) on that many
+          collections in parallel see :func:`coll_indexes_copy`
+        - coll_workers: (int) if > 1 copies that many collections concurrently largest first (see :func:`colls_schedule`)
+        - max_per_db: (int) see :func:`colls_schedule`
+        - return_results: (bool) return copy results instead of dbObjTarget (defaults to False)
+    :Returns: dbObjTarget or if return_results a DotDot {collection name: :func:`coll_copy` results}
+      with :func:`coll_indexes_copy` results under indexes key if create_indexes
     """
-    for col_name in dbObjFrom.collection_names():
-        if col_name != "system":
-            coll_copy(dbObjFrom[col_name], dbObjTarget[col_name_prefix + col_name], filter_dict=None,
-                      create_indexes=create_indexes, dropTarget=dropTarget_collections, write_options=write_options, verbose=verbose)
-    return dbObjTarget
+    def copy(collObjFrom):
+        return coll_copy(collObjFrom, dbObjTarget[col_name_prefix + collObjFrom.name], filter_dict=None,
+                         create_indexes=False, dropTarget=dropTarget_collections, write_options=write_options, verbose=verbose,
+                         workers=workers, chunk_size=chunk_size, checkpoint=checkpoint, resume=resume, raw=raw,
+                         return_results=True)
+    pairs = [(dbObjFrom[col_name], dbObjTarget[col_name_prefix + col_name])
+             for col_name in dbObjFrom.collection_names() if col_name != "system"]
+    res = DotDot()
+    if coll_workers > 1:
+        sched = colls_schedule([pair[0] for pair in pairs], copy, workers=coll_workers,
+                               max_per_db=max_per_db, verbose=verbose > 0)
+        _colls_schedule_raise(sched)
+        for col_name, col_res in sched.get(dbObjFrom.name, {}).items():
+            res[col_name] = col_res['result']
+    else:
+        for pair in pairs:
+            res[pair[0].name] = copy(pair[0])
+    if create_indexes:
+        def indexes_copy(pair):
+            return coll_indexes_copy(pair[0], pair[1], verbose=verbose > 0)
+        if index_workers > 1:
+            pool = ThreadPool(index_workers)
+            try:
+                indexes = pool.map(indexes_copy, pairs)
+            finally:
+                pool.close()
+        else:
+            indexes = [indexes_copy(pair) for pair in pairs]
+        for pair, idx_res in zip(pairs, indexes):
+            res[pair[0].name]['indexes'] = idx_res
+    return res if return_results else dbObjTarget
 
 
 def db_capped_create(db, coll_name, sizeBytes=1024 * 1000 * 100, maxDocs=None, autoIndexId=True, **kwargs):
@@ -302,14 +970,85 @@ def db_capped_set_or_get(db, coll_name, sizeBytes=2 ** 30, maxDocs=None, autoInd
         return capped_coll
 
 
-def client_schema(client, details=1, verbose=True):
+_INVENTORY_CACHE = {}  # {(id(client), stats, dbs): (time, result)} used by client_inventory
+
+
+def _coll_inventory(collection, stats):
+    """returns collection's metadata count or collStats (both O(1) on server)"""
+    if stats:
+        return col_stats(collection, indexDetails=False)
+    if hasattr(Collection, 'estimated_document_count'):   # pymongo >= 3.7, instances resolve any name
+        return collection.estimated_document_count()
+    return collection.count()
+
+
+def client_inventory(client, stats=False, dbs=None, workers=16, cache_ttl=0):
+    """fast inventory of a client's databases and collections based on metadata only (no collection scans)
+    commands are fanned out over a pool of threads
+
+    :Parameters:
+        - client: a pymongo client instance
+        - stats: (bool) collStats of each collection if True else estimated document counts (defaults to False)
+        - dbs: (list) names of databases to include (defaults to None all databases)
+        - workers: (int) number of threads (defaults to 16)
+        - cache_ttl: (int or float) seconds to reuse a previous result of same arguments (defaults to 0 no cache)
+
+    :Returns: a DotDot with keys:
+        - dbs: {db name: {collection name: count or stats}}
+        - errors: {namespace: error message} for collections that failed (i.e. views)
+        - timings: {'list': seconds listing names, 'commands': seconds of count/stats commands, 'total': seconds}
+        - cached: (bool) True if result comes from cache
+    """
+    key = (id(client), stats, tuple(dbs) if dbs is not None else None)
+    cached = _INVENTORY_CACHE.get(key)
+    if cache_ttl > 0 and cached is not None and time() - cached[0] < cache_ttl:
+        return DotDot(dict(cached[1], cached=True))
+    ts_start = time()
+    if dbs is None:
+        dbs = client.database_names()
+    pool = ThreadPool(max(1, workers))
+    try:
+        names = pool.map(lambda d: [(d, c) for c in client[d].collection_names()], dbs)
+        ts_list = time()
+
+        def inventory(namespace):
+            try:
+                return namespace, True, _coll_inventory(client[namespace[0]][namespace[1]], stats)
+            except Exception as e:
+                return namespace, False, str(e)
+        results = pool.map(inventory, [n for db_names in names for n in db_names])
+    finally:
+        pool.terminate()
+    ts_end = time()
+    rt = {'dbs': dict([(d, {}) for d in dbs]), 'errors': {}}
+    for (d, c), success, result in results:
+        if success:
+            rt['dbs'][d][c] = result
+        else:
+            rt['errors']["{}.{}".format(d, c)] = result
+    rt['timings'] = {'list': ts_list - ts_start, 'commands': ts_end - ts_list, 'total': ts_end - ts_start}
+    rt['cached'] = False
+    _INVENTORY_CACHE[key] = (ts_end, rt)
+    return DotDot(rt)
+
+
+def client_schema(client, details=1, verbose=True, fast=False, workers=16, cache_ttl=0):
     """returns and optionally prints a mongo schema containing databases and collections in use
 
     :Parameters:
         - client: a pymongo client instance
         - details: (int) level of details to print/return
         - verbose: (bool) if True prints results
+        - fast: (bool) if True returns :func:`client_inventory` results (with stats if details > 1)
+        - workers: (int) see :func:`client_inventory` (only used if fast)
+        - cache_ttl: (int or float) see :func:`client_inventory` (only used if fast)
     """
+    if fast:
+        rt = client_inventory(client, stats=details > 1, workers=workers, cache_ttl=cache_ttl)
+        if verbose:
+            pp_doc(rt['dbs'])
+        return rt
+
     def col_details(col):
         res = col.name if details == 0 else {'name': col.name}
         if details > 1:
@@ -323,8 +1062,42 @@ def client_schema(client, details=1, verbose=True):
     return rt
 
 
+BULK_MAX_BYTES = 47 * 10 ** 6
+"""default bytes limit of a bulk execute slightly below server's maxMessageSizeBytes (48000000) to leave room for overhead"""
+
+BULK_TRANSIENT_CODES = frozenset([6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436])
+"""server error codes of write errors that are worth retrying (network, time limits, write conflicts, elections)"""
+
+
+class _muBulkFind(object):
+    """returned by :meth:`muBulkOps.find` keeps compatibility with BulkOperationBuilder.find(selector) chains"""
+    def __init__(self, bulk, selector, upsert=False):
+        self._bulk = bulk
+        self._selector = selector
+        self._upsert = upsert
+
+    def update_one(self, update):
+        return self._bulk.update_one(self._selector, update, upsert=self._upsert)
+
+    def update(self, update):
+        return self._bulk.update_many(self._selector, update, upsert=self._upsert)
+
+    def replace_one(self, replacement):
+        return self._bulk.replace_one(self._selector, replacement, upsert=self._upsert)
+
+    def remove_one(self):
+        return self._bulk.delete_one(self._selector)
+
+    def remove(self):
+        return self._bulk.delete_many(self._selector)
+
+    def upsert(self):
+        return _muBulkFind(self._bulk, self._selector, upsert=True)
+
+
 class muBulkOps(object):
-    """ a wrapper around BulkOperationBuilder provides for some automation
+    """ a wrapper around collection.bulk_write provides for some automation
+    all operations (inserts, updates, replaces, upserts, deletes) are counted and auto executed the same way
 
     .. versionadded:: 1.0.6
 
@@ -333,33 +1106,88 @@ class muBulkOps(object):
         - ae_s: (int) auto execute seconds since start or last execute before a new execute is automatically initiated
           useful when we want to ensure that collection data are relative fresh
           set it to 0 (default to disable auto execute b
+        - ae_b: (int) auto execute before encoded size of pending operations exceeds ae_b bytes
+          (defaults to :data:`BULK_MAX_BYTES`) set it to 0 to disable,
+          documents are encoded once on insert so size tracking costs nothing extra
+        - async_n: (int) if > 0 batches are executed by a background thread while caller fills next batch,
+          up to async_n batches can be in flight (caller blocks when exceeded) (defaults to 0 synchronous execution)
+          errors of a background execute are raised on next call (or on :meth:`execute_if_pending`)
+          execute returns None in this mode and a batch is not necessarily written when it returns,
+          call :meth:`close` when done
+        - ae_latency: (float) if > 0 adaptive mode: after each execute ae_n grows or shrinks (up to x2 or /2 per execute)
+          so an execute takes about ae_latency seconds, on timeouts or write concern errors ae_n drops to 1/4
+          (defaults to 0 to disable) useful since best batch size depends on topology, write concern and load
+        - ae_n_min: (int) minimum ae_n in adaptive mode (defaults to 10)
+        - ae_n_max: (int) maximum ae_n in adaptive mode (defaults to 100000)
+        - retries: (int) on unordered executes failed operations with transient errors (see :data:`BULK_TRANSIENT_CODES`)
+          are retried (only those) up to retries times with exponential back off (defaults to 0 no retries)
+        - retry_sleep: (float) seconds to sleep before first retry doubled on each next one (defaults to 0.5)
+        - on_error: (function) if given on_error(request, write_error) is called for each operation that finally failed
+          instead of raising BulkWriteError (defaults to None), unordered executes only since an ordered one
+          stops on first error and operations after it are not executed, so it raises anyway
+        - dead_letters: (bool) if True operations that finally failed are appended as (request, write_error)
+          to self.dead_letters list instead of raising BulkWriteError (defaults to False) unordered only as on_error
         - dwc: (dict) or None default write concern to use in case of autoexecute_every
           DO NOT pass a WriteConcern object just a plain dict i.e {'w':1}
+        - bypass_document_validation: (bool) passed to bulk_write (defaults to False)
+        - ignore_dups: (bool) if True duplicate key errors are ignored (useful on unordered re-inserts of
+          documents that may already exist) (defaults to False) requires ordered=False since an ordered
+          execute stops on first duplicate and operations after it would be skipped silently
 
     .. Warning:: | caller should NOT in any way modify documents that are in pipeline pending execute
                  | if u are not sure use doc.copy() and be careful on swallow copies
     """
     frmt_stats = "{:s}db:{:s} collection:{:s} cnt_operations_executed:{:16,d} cnt_operations_pending:{:6,d}"
 
-    def __init__(self, collection, ordered=True, ae_n=0, ae_s=0, dwc=None):
-        """Initialize a new BulkOperationBuilder instance."""
+    def __init__(self, collection, ordered=True, ae_n=0, ae_s=0, dwc=None, ignore_dups=False, ae_b=BULK_MAX_BYTES,
+                 async_n=0, ae_latency=0, ae_n_min=10, ae_n_max=100000, retries=0, retry_sleep=0.5,
+                 on_error=None, dead_letters=False, bypass_document_validation=False):
+        """Initialize a new muBulkOps instance."""
+        if ignore_dups and ordered:
+            raise ValueError("ignore_dups requires ordered=False")
         self.collection = collection
         self.ordered = ordered
         self.ae_n = ae_n
         self.dwc = dwc
+        self.ignore_dups = ignore_dups
+        self.cnt_duplicates = 0
         self.cnt_operations_pending = 0
         self.cnt_operations_executed = 0
+        self.bytes_pending = 0
         self.ae_n = ae_n
         self.ae_s = ae_s
+        self.ae_b = ae_b
+        self.ae_latency = ae_latency
+        self.ae_n_min = ae_n_min
+        self.ae_n_max = ae_n_max
+        if ae_latency > 0 and ae_n == 0:
+            self.ae_n = min(max(1000, ae_n_min), ae_n_max)
+        self.latency_last = None
+        self.retries = retries
+        self.retry_sleep = retry_sleep
+        self.on_error = on_error
+        self.bypass_document_validation = bypass_document_validation
+        self.dead_letters = [] if dead_letters else None
+        self.cnt_retried = 0
+        self.cnt_failed = 0
         if ae_s != 0:
             self.dt_last = datetime.now()
-        self._init_builder()
-
-    def _init_builder(self):
-        self._bob = BulkOperationBuilder(collection=self.collection, ordered=self.ordered)
+        self.async_n = async_n
+        self._async_error = None
+        if async_n > 0:
+            self._async_queue = Queue()
+            self._async_slots = threading.BoundedSemaphore(async_n)
+            self._async_thread = threading.Thread(target=self._async_worker, name="muBulkOps_" + collection.name)
+            self._async_thread.daemon = True
+            self._async_thread.start()
+        self._init_requests()
+
+    def _init_requests(self):
+        self._requests = []
 
     def find(self, selector):
-        return self._bob.find(selector)
+        """compatibility with BulkOperationBuilder i.e. bulk.find({'a': 1}).upsert().update_one({'$set': {'b': 1}})"""
+        return _muBulkFind(self, selector)
 
 #     def append(self, document):
 #         return self.insert(document)
@@ -370,43 +1198,395 @@ class muBulkOps(object):
     def stats_print(self):
         print(self.stats())
 
-    def insert(self, document):
-        rt = self._bob.insert(document)
+    def _encode(self, document):
+        """encodes a document once so we know its size, pymongo sends RawBSONDocument bytes as they are"""
+        if isinstance(document, RawBSONDocument):
+            return document
+        if '_id' not in document:                   # as pymongo does
+            document['_id'] = ObjectId()
+        return RawBSONDocument(BSON.encode(document, check_keys=True, codec_options=self.collection.codec_options))
+
+    def _execute_if_bytes(self, size):
+        """executes pending operations if adding size bytes would exceed ae_b"""
+        if self.ae_b and self.cnt_operations_pending > 0 and self.bytes_pending + size > self.ae_b:
+            return self.execute(write_concern=self.dwc, recreate=True)
+
+    def _pending_added(self, size, rt=None):
+        """accounts for a new pending operation and auto executes if ae_n or ae_s conditions are met"""
         self.cnt_operations_pending += 1
-        # LOG.critical(self.stats("inserts"))
+        self.bytes_pending += size
         if self.ae_s != 0:
             current_dt = datetime.now()
-            if self.cnt_operations_pending == self.ae_n or ((current_dt - self.dt_last).seconds > self.ae_s):
+            if (self.ae_n and self.cnt_operations_pending >= self.ae_n) or ((current_dt - self.dt_last).seconds > self.ae_s):
                 self.dt_last = current_dt
                 rt = self.execute(write_concern=self.dwc, recreate=True)
-        elif self.cnt_operations_pending == self.ae_n:
+        elif self.ae_n and self.cnt_operations_pending >= self.ae_n:    # ae_n may change in adaptive mode
             rt = self.execute(write_concern=self.dwc, recreate=True)
         return rt
 
+    def _request_add(self, request, size):
+        rt = self._execute_if_bytes(size)
+        self._requests.append(request)
+        return self._pending_added(size, rt)
+
+    def _request_size(self, *docs):
+        """encoded size of documents, lists (i.e. pipeline updates, array_filters) are sized by their items"""
+        opts = self.collection.codec_options
+        return sum([sum([len(BSON.encode(i, codec_options=opts)) for i in d]) if isinstance(d, list)
+                    else len(BSON.encode(d, codec_options=opts)) for d in docs if d is not None])
+
+    def insert(self, document):
+        self._async_raise()
+        raw = self._encode(document)
+        # LOG.critical(self.stats("inserts"))
+        return self._request_add(InsertOne(raw), len(raw.raw))
+
+    def update_one(self, filter, update, upsert=False, collation=None, array_filters=None, hint=None):
+        self._async_raise()
+        return self._request_add(UpdateOne(filter, update, upsert=upsert, collation=collation,
+                                           array_filters=array_filters, hint=hint),
+                                 self._request_size(filter, update, array_filters))
+
+    def update_many(self, filter, update, upsert=False, collation=None, array_filters=None, hint=None):
+        self._async_raise()
+        return self._request_add(UpdateMany(filter, update, upsert=upsert, collation=collation,
+                                            array_filters=array_filters, hint=hint),
+                                 self._request_size(filter, update, array_filters))
+
+    def replace_one(self, filter, replacement, upsert=False, collation=None, hint=None):
+        self._async_raise()
+        return self._request_add(ReplaceOne(filter, replacement, upsert=upsert, collation=collation, hint=hint),
+                                 self._request_size(filter, replacement))
+
+    def upsert(self, filter, document_or_update):
+        """update_one with upsert if document_or_update contains update operators otherwise replace_one with upsert"""
+        if document_or_update and next(iter(document_or_update)).startswith('$'):
+            return self.update_one(filter, document_or_update, upsert=True)
+        return self.replace_one(filter, document_or_update, upsert=True)
+
+    def delete_one(self, filter, collation=None, hint=None):
+        self._async_raise()
+        return self._request_add(DeleteOne(filter, collation=collation, hint=hint), self._request_size(filter))
+
+    def delete_many(self, filter, collation=None, hint=None):
+        self._async_raise()
+        return self._request_add(DeleteMany(filter, collation=collation, hint=hint), self._request_size(filter))
+
+    def _adapt(self, cnt, seconds, backoff=False):
+        """adjusts ae_n toward ae_latency"""
+        if backoff:
+            self.ae_n = max(self.ae_n_min, self.ae_n // 4)
+            return
+        ratio = min(2.0, max(0.5, self.ae_latency / max(seconds, 0.000001)))
+        if ratio < 0.9:
+            self.ae_n = max(self.ae_n_min, int(min(self.ae_n, cnt) * ratio))
+        elif ratio > 1.1 and cnt >= self.ae_n:      # grow only if batch was full
+            self.ae_n = min(self.ae_n_max, int(self.ae_n * ratio))
+
+    def _execute_requests(self, requests, write_concern, cnt):
+        collection = self.collection.with_options(write_concern=WriteConcern(**write_concern)) if write_concern \
+            else self.collection
+        ts_start = time()
+        backoff = False
+        try:
+            rt = collection.bulk_write(requests, ordered=self.ordered,
+                                       bypass_document_validation=self.bypass_document_validation)
+            rt = rt.bulk_api_result if rt.acknowledged else None
+        except BulkWriteError as e:
+            backoff = bool(e.details.get('writeConcernErrors')) or \
+                any([err['code'] in BULK_TRANSIENT_CODES for err in e.details['writeErrors']])
+            rt = self._write_errors_handle(collection, requests, e)
+        except (AutoReconnect, ExecutionTimeout, NetworkTimeout, WTimeoutError, WriteConcernError):
+            backoff = True
+            raise
+        finally:
+            self.cnt_operations_executed += cnt
+            self.latency_last = time() - ts_start
+            if self.ae_latency > 0:
+                self._adapt(cnt, self.latency_last, backoff)
+        return rt
+
+    def _write_errors_filter(self, errors):
+        """removes duplicate key errors if we ignore them"""
+        if not self.ignore_dups:
+            return errors
+        rt = [err for err in errors if err['code'] != 11000]
+        self.cnt_duplicates += len(errors) - len(rt)
+        return rt
+
+    def _write_errors_handle(self, collection, requests, bulk_write_error):
+        """retries transient failures of an unordered execute and reports or raises permanent ones
+        :Returns: bulk api result of execute updated with retries counts, writeErrors contains final failures
+        """
+        details = bulk_write_error.details
+        errors = self._write_errors_filter(details['writeErrors'])
+        attempt = 0
+        while not self.ordered and attempt < self.retries and \
+                any([err['code'] in BULK_TRANSIENT_CODES for err in errors]):
+            transient = [err for err in errors if err['code'] in BULK_TRANSIENT_CODES]
+            errors = [err for err in errors if err['code'] not in BULK_TRANSIENT_CODES]
+            sleep(self.retry_sleep * 2 ** attempt)
+            attempt += 1
+            self.cnt_retried += len(transient)
+            try:
+                rt = collection.bulk_write([requests[err['index']] for err in transient], ordered=False,
+                                           bypass_document_validation=self.bypass_document_validation).bulk_api_result
+            except BulkWriteError as e:
+                rt = e.details
+                for err in self._write_errors_filter(rt['writeErrors']):
+                    errors.append(dict(err, index=transient[err['index']]['index']))  # index on original requests
+            for k in ('nInserted', 'nUpserted', 'nMatched', 'nModified', 'nRemoved'):
+                details[k] = details.get(k, 0) + rt.get(k, 0)
+            details.setdefault('writeConcernErrors', []).extend(rt.get('writeConcernErrors', []))
+        details['writeErrors'] = errors
+        if details.get('writeConcernErrors') or \
+                (errors and (self.ordered or (self.on_error is None and self.dead_letters is None))):
+            raise BulkWriteError(details)
+        self.cnt_failed += len(errors)
+        for err in errors:
+            if self.on_error is not None:
+                self.on_error(requests[err['index']], err)
+            else:
+                self.dead_letters.append((requests[err['index']], err))
+        return details
+
+    def _async_worker(self):
+        while True:
+            item = self._async_queue.get()
+            try:
+                if item is None:
+                    return
+                self._execute_requests(*item)
+            except Exception as e:
+                LOG.exception("muBulkOps background execute failed")
+                if self._async_error is None:
+                    self._async_error = e
+            finally:
+                self._async_queue.task_done()
+                if item is not None:
+                    self._async_slots.release()
+
+    def _async_raise(self):
+        """re raises (once) an error of a background execute"""
+        if self._async_error is not None:
+            e, self._async_error = self._async_error, None
+            raise e
+
     def execute(self, write_concern=None, recreate=True):
-        rt = self._bob.execute(write_concern=write_concern)
-        self.cnt_operations_executed += self.cnt_operations_pending
-        self.cnt_operations_pending = 0
+        self._async_raise()
+        requests, cnt = self._requests, self.cnt_operations_pending
+        self.cnt_operations_pending = 0             # requests are executed once even when it fails
+        self.bytes_pending = 0
         if recreate:
-            self._init_builder()
-        return rt
+            self._init_requests()
+        if self.async_n > 0:
+            self._async_slots.acquire()             # blocks while async_n batches are in flight
+            self._async_queue.put((requests, write_concern, cnt))
+            return None
+        return self._execute_requests(requests, write_concern, cnt)
 
     def execute_if_pending(self, write_concern=None):
-        """executes if any pending operations still exist call it on error or something"""
+        """executes if any pending operations still exist call it on error or something
+        in async mode it also waits for all batches in flight to complete
+        """
         if write_concern is None:
             write_concern = self.dwc
+        rt = None
         if self.cnt_operations_pending > 0:
-            rt = self.execute(write_concern=self.dwc, recreate=True)
-            return rt
+            rt = self.execute(write_concern=write_concern, recreate=True)
+        if self.async_n > 0:
+            self._async_queue.join()
+            self._async_raise()
+        return rt
+
+    def close(self):
+        """executes pending operations and stops background thread if any"""
+        try:
+            return self.execute_if_pending()
+        finally:
+            if self.async_n > 0 and self._async_thread.is_alive():
+                self._async_queue.put(None)
+                self._async_thread.join()
 # Collection.parallel_scan(self, num_cursors)
 
 
+class DocCache(object):
+    """a thread safe LRU cache of documents by key with size and time to live bounds used by :class:`muCollection`
+
+    :Parameters:
+        - max_size: (int) maximum number of documents, least recently used are evicted (defaults to 10000)
+        - ttl: (int or float) seconds a document is valid (defaults to 0 for ever)
+
+    generation is incremented on every invalidation so a reader can take it before reading from server
+    and pass it to :meth:`set`, a document that may have changed meanwhile is not cached
+    """
+    MISS = object()
+    """returned by :meth:`get` when key is not cached"""
+
+    def __init__(self, max_size=10000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._docs = OrderedDict()   # {key: (time, document)} least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._docs.pop(key, None)
+            if item is None or (self.ttl and time() - item[0] > self.ttl):
+                self.misses += 1
+                return self.MISS
+            self._docs[key] = item     # most recently used
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, doc, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._docs.pop(key, None)
+            self._docs[key] = (time(), doc)
+            while len(self._docs) > self.max_size:
+                self._docs.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            if self._docs.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._docs)
+            self._docs.clear()
+
+    def stats(self):
+        return DotDot({'size': len(self._docs), 'hits': self.hits, 'misses': self.misses,
+                       'evictions': self.evictions, 'invalidations': self.invalidations})
+
+
 class muCollection(Collection):
     """just a plain pymongo collection with some extra features
     it is safe to cast an existing pymongo collection to this by:
 
         >>> a_pymongo_collection_instance.__class__ = muCollection
+
+    an optional read through cache of documents by _id can be enabled by :meth:`cache_enable`
     """
+    def cache_enable(self, max_size=10000, ttl=0, oplog=True):
+        """enables a read through :class:`DocCache` used by :meth:`find_one` (when filter is an _id only)
+        and :meth:`find_by_ids`, documents are shared between callers so treat them as read only
+        (consider a :class:`LazySONDot` document class)
+
+        :Parameters:
+            - max_size: (int) see :class:`DocCache`
+            - ttl: (int or float) see :class:`DocCache`
+            - oplog: (bool) if True a background thread tails the oplog for this namespace and invalidates
+              changed documents (requires a replica set) (defaults to True), if tailing stops cache is disabled
+        :Raises: MongoUtilsError if oplog is True and server has no oplog
+        """
+        self.cache_disable()
+        cache = DocCache(max_size, ttl)
+        self._mu_cache_sub = None
+        if oplog:
+            local = self.database.client['local']
+            if 'oplog.rs' not in local.collection_names():
+                raise MongoUtilsError("oplog invalidation requires a replica set")
+            from mongoUtils.pubsub import Sub     # pubsub imports this module
+            last = local['oplog.rs'].find_one(sort=[('$natural', -1)], projection={'ts': 1})
+            self._mu_cache_sub = Sub(local['oplog.rs'], track_field='ts')
+            start_from = last['ts'] if last is not None else False   # writes after enabling are not missed
+            thread = threading.Thread(target=self._cache_oplog_tail, args=(self._mu_cache_sub, cache, start_from))
+            thread.daemon = True
+            self._mu_cache = cache
+            thread.start()
+        self._mu_cache = cache
+        return cache
+
+    def _cache_oplog_entry(self, cache, entry, cmd_ns):
+        """invalidates cache for an oplog entry, applyOps (i.e. transactions) are unpacked"""
+        if entry['op'] in ('i', 'u', 'd'):
+            if entry['ns'] == self.full_name:
+                cache.invalidate(entry.get('o2', entry['o'])['_id'])
+        elif entry['op'] == 'c':
+            cmd = entry.get('o', {})
+            if 'applyOps' in cmd:
+                for op in cmd['applyOps']:
+                    self._cache_oplog_entry(cache, op, cmd_ns)
+            elif entry['ns'] == cmd_ns or self.full_name in (cmd.get('renameCollection'), cmd.get('to')):
+                cache.clear()        # drop, rename, convertToCapped etc. not worth parsing since they are rare
+
+    def _cache_oplog_tail(self, sub, cache, start_from):
+        cmd_ns = self.database.name + '.$cmd'
+        query = {'$or': [{'ns': self.full_name}, {'ns': cmd_ns},
+                         {'op': 'c', 'o.applyOps': {'$exists': True}},
+                         {'op': 'c', 'o.renameCollection': self.full_name}, {'op': 'c', 'o.to': self.full_name}]}
+        projection = ['op', 'ns', 'o._id', 'o2._id', 'o.applyOps', 'o.renameCollection', 'o.to']
+        try:
+            for entry in sub.tail(query, projection=projection, start_from_last=start_from, sleep_secs=0.05):
+                self._cache_oplog_entry(cache, entry, cmd_ns)
+        finally:        # without invalidations cached documents can't be trusted
+            if getattr(self, '_mu_cache', None) is cache:
+                self._mu_cache = None
+                self._mu_cache_sub = None
+            cache.clear()
+
+    def cache_disable(self):
+        """disables cache and stops oplog tailing"""
+        if getattr(self, '_mu_cache_sub', None) is not None:
+            self._mu_cache_sub.stop()
+        self._mu_cache = None
+        self._mu_cache_sub = None
+
+    def cache_stats(self):
+        """:Returns: a DotDot with cache size and hits, misses, evictions, invalidations counters or None"""
+        cache = getattr(self, '_mu_cache', None)
+        return cache.stats() if cache is not None else None
+
+    def find_one(self, filter=None, *args, **kwargs):
+        """same as pymongo's find_one except that if cache is enabled and filter is an _id value or
+        {'_id': value} documents are served from cache
+        """
+        cache = getattr(self, '_mu_cache', None)
+        if cache is None or args or kwargs or filter is None:
+            return super(muCollection, self).find_one(filter, *args, **kwargs)
+        if isinstance(filter, Mapping):
+            if len(filter) != 1 or '_id' not in filter or isinstance(filter['_id'], Mapping):
+                return super(muCollection, self).find_one(filter, *args, **kwargs)
+            filter = filter['_id']
+        generation = cache.generation
+        doc = cache.get(filter)
+        if doc is DocCache.MISS:
+            doc = super(muCollection, self).find_one({'_id': filter})
+            cache.set(filter, doc, generation)     # missing documents are cached as None
+        return doc
+
+    def find_by_ids(self, ids):
+        """:Returns: a list of documents in ids order (missing ones are skipped)
+        if cache is enabled documents not in cache are fetched by a single $in query
+        """
+        cache = getattr(self, '_mu_cache', None)
+        if cache is None:
+            docs = dict([(d['_id'], d) for d in self.find({'_id': {'$in': list(ids)}})])
+        else:
+            generation = cache.generation
+            docs = dict([(i, cache.get(i)) for i in ids])
+            missed = [i for i, d in docs.items() if d is DocCache.MISS]
+            if missed:
+                for i in missed:
+                    docs[i] = None
+                for d in self.find({'_id': {'$in': missed}}):
+                    docs[d['_id']] = d
+                for i in missed:
+                    cache.set(i, docs[i], generation)
+        return [docs[i] for i in ids if docs.get(i) is not None]
+
     def stats(self, indexDetails=True, scale=2 ** 10):
         """collection statistics (see :func:`col_stats`)"""
         return col_stats(self, indexDetails, scale)
@@ -419,6 +1599,15 @@ class muCollection(Collection):
         """see :func:`coll_validate`"""
         return coll_validate(self, scandata=scandata, full=full)
 
+    def with_document_class(self, document_class=None):
+        """returns a copy of this collection decoding documents to document_class
+        (defaults to :class:`LazySONDot`)
+        """
+        codec_options = self.codec_options.with_options(document_class=document_class or LazySONDot)
+        coll = self.with_options(codec_options=codec_options)
+        coll.__class__ = muCollection
+        return coll
+
 
 class muDatabase(Database):
     """just a plain pymongo Database with some extra features
@@ -511,8 +1700,11 @@ class AuxTools(object):
               but if this id is used for insertions. Insertion order is not 100% guaranteed to correspond to this id.
               If insertion order is critical use the Optimistic Loop technique
 
-    .. todo::
-        - use a range of ids for eficiency as per last source below
+    it also keeps named checkpoints (progress documents of long running operations i.e. :func:`coll_copy`)
+    and members of named groups (i.e. consumer groups of :class:`~mongoUtils.pubsub.PubSub`)
+
+    for efficiency :meth:`sequence_next_block` hands out values from a locally held range of ids (hi-lo technique)
+    reserving a new range with a single round trip when current one is exhausted
 
     .. Seealso:: `counters collection <http://docs.mongodb.org/manual/tutorial/
         create-an-auto-incrementing-field/#auto-increment-counters-collection>`__
@@ -526,19 +1718,34 @@ class AuxTools(object):
             - all parameters are optional but exactly one must be provided
             - if collection is None a collection db[AuxCol] will be used
             - if db is None a collection on db ['AuxTools']['AuxCol'] will be used
+        - block_size: (int) size of id ranges reserved by :meth:`sequence_next_block` (defaults to 1000)
+        - prefetch: (bool) if True next range is reserved in background when half of current is used (defaults to False)
     """
-    def __init__(self, collection=None, db=None, client=None):
+    def __init__(self, collection=None, db=None, client=None, block_size=1000, prefetch=False):
         if collection is None:
             collection = db['AuxCol'] if db is not None else client['AuxTools']['AuxCol']
         self.collection = collection.with_options(read_preference=ReadPreference.PRIMARY)
         # @note make sure sequence_current gets correct value
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self._blocks = {}
+        self._blocks_lock = threading.Lock()
+
+    def _block_discard(self, seq_name):
+        """discards local range of a sequence (waits for a prefetch in progress)"""
+        with self._blocks_lock:
+            block = self._blocks.pop(seq_name, None)
+        if block is not None and block['prefetched'] is not None:
+            block['prefetched'][0].join()
 
     def sequence_reset(self, seq_name):
         """resets sequence"""
+        self._block_discard(seq_name)
         self.collection.remove({'_id': seq_name})
 
     def sequence_set(self, seq_name, val=1):
         """sets sequence's current value to val if doesn't exist it is created"""
+        self._block_discard(seq_name)
         return self.collection.find_one_and_update({'_id': seq_name}, {'$set': {'val': val}},
                                                    upsert=True, return_document=ReturnDocument.AFTER)['val']
 
@@ -552,6 +1759,96 @@ class AuxTools(object):
         return self.collection.find_one_and_update({'_id': seq_name}, {'$inc': {'val': inc}},
                                                    upsert=True, return_document=ReturnDocument.AFTER)['val']
 
+    def sequence_block(self, seq_name, block_size):
+        """reserves a range of block_size sequence values
+
+        :Returns: tuple (first, last) values of range (inclusive)
+        """
+        last = self.sequence_next(seq_name, block_size)
+        return last - block_size + 1, last
+
+    def _block_prefetch(self, seq_name, block_size):
+        """reserves a range in a background thread, returns (thread, holder) holder gets the range on success"""
+        holder = {}
+
+        def reserve():
+            holder['block'] = self.sequence_block(seq_name, block_size)
+        thread = threading.Thread(target=reserve)
+        thread.daemon = True
+        thread.start()
+        return thread, holder
+
+    def sequence_next_block(self, seq_name):
+        """returns next sequence value from a locally held range of values
+        a new range of self.block_size values is reserved when current is exhausted.
+        Method is thread safe, values are unique and monotonic within this instance
+        but values handed out by different instances interleave
+
+        .. Warning:: don't mix it with :meth:`sequence_next` on same sequence within same instance
+        """
+        return self.sequence_next_block_many(seq_name, 1)[0]
+
+    def sequence_next_block_many(self, seq_name, n):
+        """returns a list of next n sequence values from same locally held range as :meth:`sequence_next_block`
+        what is left of current range is used first, if more values are needed a new range
+        of at least n values is reserved so values stay monotonic within this instance
+        """
+        rt = []
+        with self._blocks_lock:
+            while len(rt) < n:
+                block = self._blocks.get(seq_name)
+                if block is None or block['next'] > block['last']:
+                    first_last = None
+                    if block is not None and block['prefetched'] is not None:
+                        thread, holder = block['prefetched']
+                        thread.join()
+                        first_last = holder.get('block')  # None if prefetch failed
+                    if first_last is None:
+                        first_last = self.sequence_block(seq_name, max(self.block_size, n - len(rt)))
+                    block = self._blocks[seq_name] = {'next': first_last[0], 'last': first_last[1],
+                                                      'prefetched': None}
+                take = min(n - len(rt), block['last'] - block['next'] + 1)
+                rt.extend(range(block['next'], block['next'] + take))
+                block['next'] += take
+            if self.prefetch and block['prefetched'] is None and block['last'] - rt[-1] < self.block_size // 2:
+                block['prefetched'] = self._block_prefetch(seq_name, self.block_size)
+        return rt
+
+    def checkpoint_get(self, name):
+        """returns checkpoint document or None if doesn't exist"""
+        return self.collection.find_one({'_id': name})
+
+    def checkpoint_set(self, name, **kwargs):
+        """sets checkpoint fields (kwargs) if checkpoint doesn't exist it is created"""
+        kwargs['dt'] = datetime.utcnow()
+        return self.collection.update_one({'_id': name}, {'$set': kwargs}, upsert=True)
+
+    def checkpoint_add(self, name, field, value):
+        """adds value to a checkpoint's array field (if not already there)"""
+        return self.collection.update_one({'_id': name}, {'$addToSet': {field: value}, '$set': {'dt': datetime.utcnow()}},
+                                          upsert=True)
+
+    def checkpoint_reset(self, name):
+        """removes a checkpoint"""
+        return self.collection.delete_one({'_id': name})
+
+    def member_set(self, group, member):
+        """registers (or refreshes as a heartbeat) a member of a named group"""
+        return self.collection.update_one({'_id': "{}|{}".format(group, member)},
+                                          {'$set': {'group': group, 'member': member, 'dt': datetime.utcnow()}},
+                                          upsert=True)
+
+    def member_remove(self, group, member):
+        """removes a member from a named group"""
+        return self.collection.delete_one({'_id': "{}|{}".format(group, member)})
+
+    def members_get(self, group, max_age_secs=None):
+        """returns sorted names of group's members, if max_age_secs only those refreshed within last max_age_secs"""
+        query = {'group': group}
+        if max_age_secs is not None:
+            query['dt'] = {'$gte': datetime.utcnow() - timedelta(seconds=max_age_secs)}
+        return sorted([d['member'] for d in self.collection.find(query, projection={'member': 1})])
+
 
 class SONDot(SON):
     """
@@ -574,6 +1871,155 @@ class SONDot(SON):
         return item
 
 
+_BSON_FIXED_SIZES = {1: 8, 6: 0, 7: 12, 8: 1, 9: 8, 10: 0, 16: 4, 17: 8, 18: 8, 19: 16, 127: 0, 255: 0}
+_UNPACK_INT = Struct('<i').unpack_from
+_byte_at = getitem if bytes is not str else lambda buf, i: ord(buf[i])   # python 2 indexes bytes to str
+
+
+def _bson_value_end(buf, bson_type, i):
+    """returns offset where a BSON value of bson_type starting at offset i ends"""
+    if bson_type in (2, 13, 14):                        # string, code, symbol
+        return i + 4 + _UNPACK_INT(buf, i)[0]
+    if bson_type in (3, 4, 15):                         # document, array, code with scope
+        return i + _UNPACK_INT(buf, i)[0]
+    if bson_type == 5:                                  # binary
+        return i + 5 + _UNPACK_INT(buf, i)[0]
+    if bson_type == 11:                                 # regex two cstrings
+        return buf.index(b'\x00', buf.index(b'\x00', i) + 1) + 1
+    if bson_type == 12:                                 # DBPointer
+        return i + 4 + _UNPACK_INT(buf, i)[0] + 12
+    raise InvalidBSON("unknown BSON type {}".format(bson_type))
+
+
+class LazySONDot(RawBSONDocument):
+    """
+    A read only document with :class:`SONDot` semantics backed by raw BSON bytes, elements are scanned only up to
+    the field requested and a field is decoded only when first accessed, nested documents are views on same buffer
+    (no copies) and decoded values are cached.
+    Use it as document_class in CodecOptions when only a few fields of large documents are read
+    (see :func:`mongoUtils.benchmarks.bm_document_classes`)
+
+    :Example:
+        >>> coll = db.muTest_tweets.with_options(codec_options=CodecOptions(document_class=LazySONDot))
+        >>> coll.find_one().user.screen_name
+        'Albert000G'
+
+    .. Note:: arrays are decoded as a whole (documents in arrays as :class:`SONDot`),
+              it can be written back as it is since pymongo sends its raw bytes
+    """
+    __slots__ = ('_buf', '_start', '_end', '_opts', '_opts_decode', '_index', '_scan_pos', '_cache')
+
+    def __init__(self, bson_bytes, codec_options=None):
+        self._view_init(bson_bytes, 0, len(bson_bytes), codec_options or DEFAULT_CODEC_OPTIONS, None)
+
+    def _view_init(self, buf, start, end, opts, opts_decode):
+        self._buf = buf
+        self._start = start
+        self._end = end
+        self._opts = opts
+        self._opts_decode = opts_decode
+        self._index = {}            # {name bytes: (bson type, element start, value start, value end)}
+        self._scan_pos = start + 4
+        self._cache = {}
+
+    @classmethod
+    def _view(cls, buf, start, end, opts, opts_decode):
+        view = cls.__new__(cls)
+        view._view_init(buf, start, end, opts, opts_decode)
+        return view
+
+    @property
+    def raw(self):
+        """raw BSON bytes of this document"""
+        if self._start == 0 and self._end == len(self._buf):
+            return self._buf
+        return self._buf[self._start:self._end]
+
+    def _scan(self, name=None):
+        """indexes elements' headers up to element name (or to the end) without decoding values"""
+        buf, index, fixed = self._buf, self._index, _BSON_FIXED_SIZES
+        i, end = self._scan_pos, self._end - 1
+        while i < end:
+            bson_type = _byte_at(buf, i)
+            name_end = buf.index(b'\x00', i + 1)
+            size = fixed.get(bson_type)
+            value_end = name_end + 1 + size if size is not None else _bson_value_end(buf, bson_type, name_end + 1)
+            elem_name = buf[i + 1:name_end]
+            index[elem_name] = (bson_type, i, name_end + 1, value_end)
+            i = value_end
+            if elem_name == name:
+                break
+        self._scan_pos = i
+
+    def _decode(self, key, elem):
+        bson_type, elem_start, value_start, value_end = elem
+        if self._opts_decode is None:
+            self._opts_decode = self._opts.with_options(document_class=SONDot)
+        if bson_type == 3 and self._buf[value_start + 4:value_start + 10] != b'\x02$ref\x00':   # DBRefs are decoded
+            return self._view(self._buf, value_start, value_end, self._opts, self._opts_decode)
+        elem_bytes = self._buf[elem_start:value_end]
+        return BSON(pack('<i', len(elem_bytes) + 5) + elem_bytes + b'\x00').decode(self._opts_decode)[key]
+
+    def _elem(self, key):
+        """returns index entry of key or None"""
+        try:
+            name = key.encode('utf-8')
+        except AttributeError:
+            return None
+        elem = self._index.get(name)
+        if elem is None and self._scan_pos < self._end - 1:
+            self._scan(name)
+            elem = self._index.get(name)
+        return elem
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        elem = self._elem(key)
+        if elem is None:
+            raise KeyError(key)
+        value = self._cache[key] = self._decode(key, elem)
+        return value
+
+    def __getattr__(self, attr):
+        if attr in LazySONDot.__slots__:
+            raise AttributeError(attr)
+        try:
+            return self[attr]
+        except KeyError as e:
+            raise AttributeError(e)
+
+    def __iter__(self):
+        self._scan()
+        return iter([name.decode('utf-8') for name, elem in sorted(self._index.items(), key=lambda x: x[1][1])])
+
+    def __len__(self):
+        self._scan()
+        return len(self._index)
+
+    def __contains__(self, key):
+        return self._elem(key) is not None
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def __eq__(self, other):
+        if isinstance(other, RawBSONDocument):
+            return self.raw == other.raw
+        if isinstance(other, Mapping):
+            return len(self) == len(other) and all([k in other and self[k] == other[k] for k in self])
+        return NotImplemented
+
+    def __ne__(self, other):
+        rt = self.__eq__(other)
+        return rt if rt is NotImplemented else not rt
+
+    def __repr__(self):
+        return "LazySONDot({!r})".format(SON(self.items()))
+
+
 def parse_js(file_path, function_name, replace_vars=None):
     """
     | helper function to get a js function string from a file containing js functions
@@ -629,20 +2075,66 @@ def geo_near_point_q(geo_field, Long_Lat, query={}, minDistance=None, maxDistanc
     return query
 
 
-def field_counts(collection, field, sort=True, incl_perc=True):
+def field_counts(collection, field, sort=True, incl_perc=True, strategy='auto', limit=None, workers=4,
+                 max_index_values=30, large_docs=10 ** 7):
     """a group counts function with functionality simillar to aggregation $group
-    it is more performant than aggregation or a map reduce equivelant when distinct values of field
-    are a small number < ~30 and field is indexed.
+    counts documents by value of field (documents missing field are not counted)
+    using one of following strategies:
+
+        - 'index':  distinct values and a count per value executed in parallel (covered by index if field is indexed)
+          it is more performant than aggregation when distinct values of field are a small number and field is indexed
+        - 'group': a single $group aggregation
+        - 'sortByCount': a single $sortByCount aggregation with allowDiskUse, limit is applied on server
+          so only most frequent values are returned
 
     :Parameters:
         - collection: a pymongo collection object
         - field: (str) field name
-        - sort: (True) sort results by value if True
+        - sort: (True) sort results by count if True
         - incl_perc: (bool) include percentages if True
+        - strategy: (str) one of above strategies or 'auto' (defaults to 'auto')
+            - 'auto' uses 'index' if field is indexed and a sample of 1000 documents has up to max_index_values
+              distinct values else
+              'sortByCount' if limit is given or collection has more than large_docs documents else 'group'
+        - limit: (int) maximum number of values to return most frequent ones except for 'group' strategy
+          where first limit groups are returned (defaults to None all values)
+        - workers: (int) number of threads for 'index' strategy (defaults to 4)
+        - max_index_values: (int) see strategy (defaults to 30)
+        - large_docs: (int) see strategy (defaults to 10 ** 7)
+
+    :Returns: list of [value, count] or [value, count, percentage] items
     """
-    rt = [[v, collection.find({field: v}).count()] for v in collection.distinct(field)]
+    if strategy == 'auto':
+        strategy = 'group'
+        if field in coll_index_names(collection):   # estimate cardinality from a sample
+            pipeline = [{'$sample': {'size': 1000}}, {'$group': {'_id': '$' + field}}, {'$limit': max_index_values + 1}]
+            if len(list(collection.aggregate(pipeline))) <= max_index_values:
+                strategy = 'index'
+        if strategy != 'index' and (limit is not None or collection.count() > large_docs):
+            strategy = 'sortByCount'
+    match = {'$match': {field: {'$exists': True}}}
+    if strategy == 'index':
+        values = collection.distinct(field)
+        pool = ThreadPool(max(1, min(workers, len(values))))
+        try:
+            rt = pool.map(lambda v: [v, collection.count({field: v})], values)
+        finally:
+            pool.terminate()
+        if limit is not None:
+            rt = sorted(rt, key=lambda x: x[1], reverse=True)[:limit]
+    elif strategy == 'group':
+        cursor = collection.aggregate([match, {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}],
+                                      allowDiskUse=True)
+        rt = [[d['_id'], d['count']] for d in islice(cursor, limit)]
+    elif strategy == 'sortByCount':
+        pipeline = [match, {'$sortByCount': '$' + field}]
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+        rt = [[d['_id'], d['count']] for d in collection.aggregate(pipeline, allowDiskUse=True)]
+    else:
+        raise ValueError("strategy must be one of 'auto', 'index', 'group', 'sortByCount'")
     if incl_perc:
-        total = float(sum([i[1] for i in rt]))
+        total = float(sum([i[1] for i in rt]) if limit is None else collection.count({field: {'$exists': True}}))
         for i in rt:
             i.append(100.0 * (i[1]/total))
     if sort:
@@ -690,40 +2182,114 @@ def oid_date_range_filter(dt_from=None, dt_upto=None, field_name='_id'):
     return q if field_name is None else SON([(field_name, q)])
 
 
-def OID_gaps(col=None, ObjectId_field="_id", threshold_secs=60):
-        """ finds gaps in collections Object_id)
-        """
+def _numpy_on_demand():
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            print ("this function requires numpy library please install (pip install numpy")
+            raise
+    return np
 
-        frmt = "|docs:{:12,d}|of {:12,d}| %: {:4.4f}|"
-        frmtgap = "|{}|{}|from:{}|to:{}|gap ddd-hh-mm:ss: {}|"
-        res = DotDot({'count': float(col.count()), 'cnt': 0, 'gaps': []})
-        step = int(res.count/100)
-        curs = col.find(sort=[(ObjectId_field, 1)], projection={ObjectId_field: 1})
-        last_doc_gt = curs[0][ObjectId_field].generation_time
-        first_doc_gt = curs[0][ObjectId_field].generation_time
-        res.dt_start = first_doc_gt
-        for doc in curs:
-            res.cnt += 1
-            if res.cnt == 1 or res.cnt % 100000 == step:
-                print(frmt.format(res.cnt, int(res.count), 100 * (res.cnt/res.count)))
-            doc_time = doc[ObjectId_field].generation_time
-            timedelta_secs = abs((doc_time - last_doc_gt).total_seconds())
-            if timedelta_secs > threshold_secs:
-                r = (ObjectId_field, str(doc[ObjectId_field]), last_doc_gt, doc_time, seconds_to_DHMS(timedelta_secs))
-                print (frmtgap.format(*r))
-                res.gaps.append(r)
-            last_doc_gt = doc_time
-        res.seconds_total = timedelta_secs = abs((doc_time - first_doc_gt).total_seconds())
-        res.docsPerSecond = res.count / res.seconds_total
-        res.dt_end = last_doc_gt
+
+def _oid_timestamps(collection, query, field_name="_id", batch_bytes=2 ** 24):
+    """fetches ObjectId field_name values of documents matching query in raw server batches and returns the 4 bytes
+    generation timestamps as a NumPy array sorted by field_name (documents are never decoded)
+    with a first level field each projected document has same size so a batch is read as a structured array
+    """
+    query = dict(query)
+    query[field_name] = dict(query.get(field_name, {}), **{'$type': 7})   # ObjectId values only
+    projection = {'_id': 1} if field_name == '_id' else {'_id': 0, field_name: 1}
+    name = field_name.encode('utf-8')
+    offset = 4 + 1 + len(name) + 1   # doc length, type, field_name cstring
+    if b'.' not in name:
+        record = np.dtype([('size', '<i4'), ('type', 'u1'), ('name', 'S{}'.format(len(name) + 1)),
+                           ('ts', '>u4'), ('oid_rest', 'S8'), ('eoo', 'u1')])
+        cursor = collection.find_raw_batches(query, projection=projection, sort=[(field_name, 1)],
+                                             batch_size=max(1, batch_bytes // record.itemsize))
+        arrays = []
+        for batch in cursor:
+            records = np.frombuffer(batch, dtype=record)
+            if len(records) and (records['size'] != record.itemsize).any():
+                raise MongoUtilsError("unexpected documents in {} raw batches".format(field_name))
+            arrays.append(records['ts'])
+        return np.concatenate(arrays).astype(np.int64) if arrays else np.zeros(0, dtype=np.int64)
+    raw_coll = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    cursor = raw_coll.find(query, projection=projection, sort=[(field_name, 1)])
+    arrays = [np.frombuffer(b''.join([doc.raw[offset:offset + 4] for doc in batch]), dtype='>u4')
+              for batch in _raw_batches(cursor, batch_bytes)]
+    return np.concatenate(arrays).astype(np.int64) if arrays else np.zeros(0, dtype=np.int64)
+
+
+def OID_gaps(col=None, ObjectId_field="_id", threshold_secs=60, bucket_secs=3600, workers=0, chunk_size=10 ** 6,
+             batch_bytes=2 ** 24, verbose=True):
+    """finds gaps in a collection's ObjectId field i.e. periods with no inserts
+    ObjectId values are fetched in raw batches and their generation timestamps are decoded into a NumPy array
+    so gaps and throughput are computed vectorized (requires numpy)
+
+    :Parameters:
+        - col: (obj) a pymongo collection
+        - ObjectId_field: (str) an indexed field with ObjectId values (defaults to _id)
+        - threshold_secs: (int) report gaps longer than threshold_secs (defaults to 60)
+        - bucket_secs: (int) seconds of each time bucket for throughput statistics (defaults to 3600)
+        - workers: (int) if > 0 ObjectId range is split by :func:`coll_chunks` and fetched
+          by :func:`coll_parallel_scan` with that many workers (defaults to 0 single stream)
+        - chunk_size: (int or float) see :func:`coll_chunks` (only used if workers > 0)
+        - batch_bytes: (int) size in bytes of raw batches (defaults to 2 ** 24)
+        - verbose: (bool) prints gaps if True
+
+    :Returns: a DotDot with keys:
+        - count, dt_start, dt_end, seconds_total, docsPerSecond
+        - gaps: list of tuples (ObjectId_field, ObjectId after gap as str, datetime from, datetime to, gap DHMS)
+        - buckets: list of tuples (bucket start datetime, documents, documents per second)
+        - seconds: elapsed seconds
+    """
+    _numpy_on_demand()
+    frmtgap = "|{}|{}|from:{}|to:{}|gap ddd-hh-mm:ss: {}|"
+    ts_start = time()
+    if workers > 0:
+        res = coll_parallel_scan(col, lambda c, q: _oid_timestamps(c, q, ObjectId_field, batch_bytes),
+                                 ObjectId_field, chunk_size, workers=workers, verbose=False)
+        if res.failed:
+            raise MongoUtilsError("OID_gaps failed on chunks {}".format(sorted(res.failed.keys())))
+        stamps = np.concatenate(res.results) if res.results else np.zeros(0, dtype=np.int64)
+    else:
+        stamps = _oid_timestamps(col, {}, ObjectId_field, batch_bytes)
+    res = DotDot({'count': len(stamps), 'gaps': [], 'buckets': []})
+    if res.count == 0:
+        res.seconds = time() - ts_start
+        return res
+    utc = datetime.utcfromtimestamp
+    diffs = np.diff(stamps)
+    for i in np.nonzero(diffs > threshold_secs)[0]:
+        dt_from, dt_to = utc(int(stamps[i])), utc(int(stamps[i + 1]))
+        doc = col.find_one({ObjectId_field: {'$gte': ObjectId.from_datetime(dt_to)}},
+                           projection={ObjectId_field: 1}, sort=[(ObjectId_field, 1)])
+        res.gaps.append((ObjectId_field, str(doc[ObjectId_field]), dt_from, dt_to, seconds_to_DHMS(int(diffs[i]))))
+    buckets, counts = np.unique(stamps // bucket_secs, return_counts=True)
+    res.buckets = [(utc(int(b * bucket_secs)), int(c), int(c) / float(bucket_secs)) for b, c in zip(buckets, counts)]
+    res.dt_start, res.dt_end = utc(int(stamps[0])), utc(int(stamps[-1]))
+    res.seconds_total = int(stamps[-1] - stamps[0])
+    res.docsPerSecond = res.count / float(res.seconds_total or 1)
+    res.seconds = time() - ts_start
+    if verbose:
         for g in res.gaps:
             print (frmtgap.format(*g))
-        return res
+    return res
 
 
-def db_counts(mongo_client, verbose=True):
+def db_counts(mongo_client, verbose=True, fast=False, workers=16, cache_ttl=0):
     """ returns document counts for each collection in client's db
+
+    :Parameters:
+        - mongo_client: a pymongo client instance
+        - fast: (bool) if True returns :func:`client_inventory` results with estimated counts (defaults to False)
+        - workers: (int) see :func:`client_inventory` (only used if fast)
+        - cache_ttl: (int or float) see :func:`client_inventory` (only used if fast)
     """
+    if fast:
+        return client_inventory(mongo_client, stats=False, workers=workers, cache_ttl=cache_ttl)
     res = {}
     for db in mongo_client.database_names():
         res[db] = {}
@@ -98,6 +98,8 @@ class muModel(object):
 
     def __init__(self, db, parent_model=None, codec_options=None, write_concern=None, read_concern=None, read_preference=None,  drop=False):
         """
+        codec_options is the document class of returned documents i.e. SON or
+        :class:`~mongoUtils.helpers.LazySONDot` to decode fields lazily
         """
         self._db = db
         self._col = None
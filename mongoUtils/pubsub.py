@@ -6,10 +6,16 @@ import os
 from pymongo.errors import AutoReconnect, NotMasterError, ServerSelectionTimeoutError
 from pymongo.cursor import CursorType
 from pymongo import collection, ReturnDocument
-from bson.objectid import ObjectId
 from bson import SON, CodecOptions
+from bson.int64 import Int64
 from time import sleep, time
-from mongoUtils.helpers import AuxTools, db_capped_set_or_get, MongoUtilsError
+import threading
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+import random
+from mongoUtils.helpers import AuxTools, db_capped_set_or_get, coll_track_field_suggest, MongoUtilsError
 from mongoUtils.aggregation import Aggregation
 from Hellas.Delphi import auto_retry
 from Hellas.Pella import obj_id_expanded
@@ -100,12 +106,7 @@ class Sub(object):
         self._counters = {"cnt1": 0, 'cnt2': 0}  # only used for debugging  (not thread safe)
 
     def _suggest_track_field(self):
-        doc_first = self._collection.find_one()
-        if doc_first is not None and self._capped is True and 'ts' in doc_first.keys():
-            return 'ts'
-        if doc_first is not None and isinstance(doc_first['_id'], ObjectId):
-            return '_id'
-        return None
+        return coll_track_field_suggest(self._collection, self._capped is True)
 
     @property
     def name(self):
@@ -269,18 +270,30 @@ class PubSub(Sub):
         - reset:   (bool) drops & recreates collection and resets id counters if True
         - size:    (int) capped collection size in bytes
         - max_docs:(int) capped collection max documents count
+        - id_block_size: (int) if > 0 message ids are handed out from locally reserved ranges of that size
+          (see :meth:`~mongoUtils.helpers.AuxTools.sequence_next_block`) saving a round trip per message,
+          ids remain unique but with more than one publishers ts order doesn't follow publishing order, since
+          :meth:`poll` and :meth:`tail` resume after the last ts seen, their consumers will **miss** messages
+          published with a lower ts by an other publisher, so use it only with a single publisher
+          or when all consumers use :meth:`claim` (defaults to 0)
+        - id_prefetch: (bool) reserve next range of ids in background (only if id_block_size > 0) (defaults to False)
+        - document_class: document class of received messages (defaults to SON) use
+          :class:`~mongoUtils.helpers.LazySONDot` to decode only the fields consumers actually read
     """ 
     _dt_frmt_info = "{} {:%Y-%m-%d %H:%M:%S %f}"
 
     def __init__(self, collection_or_name, db=None, name=None, incl_parent=False,
                  capped=True, reset=False,
                  size=2 ** 30,  # ~1 GB
-                 max_docs=None):
-        self._coll_init_specs = {'capped': capped, 'size': size, 'max_docs': max_docs}
+                 max_docs=None, id_block_size=0, id_prefetch=False, document_class=SON):
+        self._coll_init_specs = {'capped': capped, 'size': size, 'max_docs': max_docs, 'document_class': document_class}
         self._max_name_len = 32
         self._reserve_name = " " * self._max_name_len  # reserved bytes in a document to ensure it will not change size
         self._incl_parent = incl_parent
         self._autothrottle = False
+        self._batch = None
+        self._ackn_buffer = None
+        self._group = None
         if isinstance(collection_or_name, collection.Collection):
             self._col_name = collection_or_name.name
             self.db = collection_or_name.database
@@ -288,7 +301,7 @@ class PubSub(Sub):
             self._col_name = collection_or_name
             assert(db is not None)
             self.db = db
-        self.aux_tools = AuxTools(db=self.db)
+        self.aux_tools = AuxTools(db=self.db, block_size=id_block_size, prefetch=id_prefetch)
         if reset:
             self.reset()
         a_collection = self._create_collection()
@@ -333,13 +346,22 @@ class PubSub(Sub):
             a_collection = db_capped_set_or_get(self.db, self._col_name, specs['size'], specs['max_docs'])
         else:
             a_collection = self.db[self._col_name]
-        opts = CodecOptions(document_class=SON)
+        opts = CodecOptions(document_class=specs['document_class'])
         a_collection = a_collection.with_options(codec_options=opts)
         return a_collection
 
     def _id_next(self):
+        if self.aux_tools.block_size > 0:
+            return self.aux_tools.sequence_next_block(self._col_name)
         return self.aux_tools.sequence_next(self._col_name)
 
+    def _id_next_many(self, n):
+        """n ids from same allocator as :meth:`_id_next`"""
+        if self.aux_tools.block_size > 0:
+            return self.aux_tools.sequence_next_block_many(self._col_name, n)
+        ts_first, ts_last = self.aux_tools.sequence_block(self._col_name, n)
+        return list(range(ts_first, ts_last + 1))
+
     def _acknowledge(self, fltr, up):
         return self._collection.find_one_and_update(fltr, up, upsert=False, return_document=ReturnDocument.AFTER)
 
@@ -367,20 +389,137 @@ class PubSub(Sub):
             raise MongoUtilsPubSubError('message not found')
         return rt
 
-    @auto_retry(AutoReconnect, 6, 1, 1)  # todo: check new pymongo errors
-    def _insert_msg(self, payload, topic, verb, target, state, ackn, parent=0, sentBy=None):
+    def acknowledge_done_many(self, msgs, state=MsgState.SUCCES):
+        """marks messages received by this instance as done with a single update_many
+
+        :Parameters:
+            - msgs: (list) messages or their _ids
+            - state: MsgState to set (defaults to MsgState.SUCCES)
+        :Returns: a DotDot with matched, modified counts and unmatched: list of _ids that were not updated
+          (i.e. not in RECEIVED state or received by an other instance)
+        """
+        def id_key(_id):        # our _ids are (unhashable) sub documents
+            return tuple(_id.items()) if isinstance(_id, Mapping) else _id
+
+        ids = [m['_id'] if isinstance(m, Mapping) and '_id' in m else m for m in msgs]
+        if not ids:
+            return DotDot({'matched': 0, 'modified': 0, 'unmatched': []})
+        completed = int(time())
+        fltr = {'_id': {'$in': ids}, 'status.state': MsgState.RECEIVED, 'status.receivedBy': self._name_max}
+        rt = self._collection.update_many(fltr, {'$set': {'status.state': state, 'dt.completed': completed}})
+        unmatched = []
+        if rt.matched_count < len(ids):    # one more query only to find which ones
+            done = self._collection.find({'_id': {'$in': ids}, 'status.state': state, 'dt.completed': completed,
+                                          'status.receivedBy': self._name_max}, projection={'_id': 1})
+            done = set([id_key(d['_id']) for d in done])
+            unmatched = [i for i in ids if id_key(i) not in done]
+        return DotDot({'matched': rt.matched_count, 'modified': rt.modified_count, 'unmatched': unmatched})
+
+    def acknowledge_buffer_set(self, max_msgs=100, max_secs=1):
+        """must be called explicitly after instantiation to use :meth:`acknowledge_done_buffered`
+        buffered acknowledgements are flushed by :meth:`acknowledge_done_many` when max_msgs are buffered
+        or the oldest has waited for max_secs (checked on each new acknowledgement and by a background thread)
+        or explicitly by :meth:`acknowledge_flush`.
+        call :meth:`acknowledge_buffer_stop` to acknowledge whatever is left
+        """
+        self.acknowledge_buffer_stop()
+        self._ackn_buffer = DotDot({'max_msgs': max_msgs, 'max_secs': max_secs, 'continue': True})
+        self._ackn_msgs = {}            # {state: [_id, ...]}
+        self._ackn_ts = None
+        self._ackn_lock = threading.Lock()
+        self._ackn_error = None
+        self._ackn_thread = threading.Thread(target=self._ackn_linger)
+        self._ackn_thread.daemon = True
+        self._ackn_thread.start()
+
+    def acknowledge_buffer_stop(self):
+        """acknowledges buffered messages and disables buffering"""
+        if self._ackn_buffer is None:
+            return []
+        self._ackn_buffer['continue'] = False
+        self._ackn_thread.join()
+        self._ackn_raise()
+        rt = self.acknowledge_flush()    # on failure buffering stays set so acknowledgements are kept for a retry
+        self._ackn_buffer = None
+        return rt
+
+    def _ackn_linger(self):
+        max_secs = self._ackn_buffer.max_secs
+        while self._ackn_buffer['continue']:
+            sleep(min(max_secs / 2.0, 1))     # so stop doesn't wait long
+            if self._ackn_ts is not None and time() - self._ackn_ts >= max_secs:
+                try:
+                    self.acknowledge_flush()
+                except Exception as e:
+                    self._ackn_error = e
+
+    def _ackn_raise(self):
+        """raises an error of a background acknowledgement on caller's thread"""
+        if self._ackn_error is not None:
+            e, self._ackn_error = self._ackn_error, None
+            raise e
+
+    def acknowledge_done_buffered(self, msg, state=MsgState.SUCCES):
+        """same as :meth:`acknowledge_done` but buffered see :meth:`acknowledge_buffer_set`
+
+        :Returns: a list of :meth:`acknowledge_done_many` results if it caused a flush else None
+        :Raises: MongoUtilsPubSubError if buffering is not set
+        """
+        if self._ackn_buffer is None:
+            raise MongoUtilsPubSubError('acknowledge_buffer_set must be called first')
+        self._ackn_raise()
+        with self._ackn_lock:
+            if self._ackn_ts is None:
+                self._ackn_ts = time()
+            self._ackn_msgs.setdefault(state, []).append(msg['_id'])
+        return self._ackn_buffer_check()
+
+    def _ackn_buffer_check(self):
+        if self._ackn_buffer is None or self._ackn_ts is None:
+            return None
+        if sum([len(v) for v in self._ackn_msgs.values()]) >= self._ackn_buffer.max_msgs or \
+                time() - self._ackn_ts >= self._ackn_buffer.max_secs:
+            return self.acknowledge_flush()
+
+    def acknowledge_flush(self):
+        """acknowledges buffered messages, on failure those not acknowledged are put back in buffer
+
+        :Returns: a list of :meth:`acknowledge_done_many` results one per state
+        """
+        if self._ackn_buffer is None:
+            return []
+        with self._ackn_lock:
+            msgs, ts, self._ackn_msgs, self._ackn_ts = self._ackn_msgs, self._ackn_ts, {}, None
+        rt = []
+        try:
+            for state in list(msgs):
+                rt.append(self.acknowledge_done_many(msgs[state], state))
+                del msgs[state]
+        except Exception:
+            with self._ackn_lock:
+                for state, ids in msgs.items():
+                    self._ackn_msgs[state] = ids + self._ackn_msgs.get(state, [])
+                self._ackn_ts = ts
+            raise
+        return rt
+
+    def _msg_build(self, ts, payload, topic, verb, target, state, ackn, parent=0, sentBy=None):
         """we use SON to ensure order so we can index properly
         """
         if sentBy is None:
             sentBy = self.name
-        ts = self._id_next()
         _id = SON([('id', ts), ('parent', parent)]) if self._incl_parent else SON([('id', ts)])
         address = SON([('topic', topic), ('verb', verb), ('target', target)])
         dt = SON([('sent', int(time())), ('received', 0), ('completed', 0)])
         status = SON([('state', state), ('sentBy', sentBy),
-                      ('receivedBy', self._reserve_name)])  # reserve space so document will not grow on update
-        msg = SON([('_id', _id), ('ts', ts),  ('ackn', ackn), ('address', address),
-                   ('status', status), ('dt', dt), ('payload', payload)])
+                      ('receivedBy', self._reserve_name),     # reserve space so document will not grow on update
+                      ('claim', Int64(0))])                   # same for claim token see claim
+        return SON([('_id', _id), ('ts', ts),  ('ackn', ackn), ('address', address),
+                    ('status', status), ('dt', dt), ('payload', payload)])
+
+    @auto_retry(AutoReconnect, 6, 1, 1)  # todo: check new pymongo errors
+    def _insert_msg(self, payload, topic, verb, target, state, ackn, parent=0, sentBy=None):
+        msg = self._msg_build(self._id_next(), payload, topic, verb, target, state, ackn, parent, sentBy)
         return self._collection.insert_one(msg)
 
     def pub(self, payload, topic='', verb='', target=None, ackn=Acknowledge.RECEIPT, sentBy=None):
@@ -392,11 +531,99 @@ class PubSub(Sub):
             - target: str or None specifies target(s) name
             - ackn: Request acknowledge see: :class: Acknowledge class
             - sendBy: str or None identifies sender (if None defaults to instance name)
+
+        :Returns: pymongo's InsertOneResult or None if batching is enabled (see :meth:`pub_batching_set`)
         """
+        if self._batch is not None:
+            return self._batch_add({'payload': payload, 'topic': topic, 'verb': verb, 'target': target,
+                                    'ackn': ackn, 'sentBy': sentBy})
         if self._autothrottle is not False:
             self._autothrottle_check()
         return self._insert_msg(payload, topic, verb, target, state=MsgState.SENT, ackn=ackn, sentBy=sentBy)
 
+    @auto_retry(AutoReconnect, 6, 1, 1)
+    def pub_many(self, messages):
+        """publishes a batch of messages with a single ids reservation and a single ordered insert_many
+
+        :Parameters:
+            - messages: (list) of dictionaries with :meth:`pub` arguments
+              i.e. [{'payload': {'cnt': 1}, 'topic': 'foo'}, ...] missing arguments get pub's defaults
+        :Returns: pymongo's InsertManyResult or None if messages is empty
+        """
+        messages = list(messages)
+        if not messages:
+            return None
+        if self._autothrottle is not False:
+            self._autothrottle_check()
+        ids = self._id_next_many(len(messages))
+        msgs = [self._msg_build(ids[i], m['payload'], m.get('topic', ''), m.get('verb', ''), m.get('target'),
+                                MsgState.SENT, m.get('ackn', Acknowledge.RECEIPT), sentBy=m.get('sentBy'))
+                for i, m in enumerate(messages)]
+        return self._collection.insert_many(msgs, ordered=True)
+
+    def pub_batching_set(self, max_msgs=1000, linger_secs=0.05):
+        """must be called explicitly after instantiation if we want :meth:`pub` to buffer messages and publish them
+        by :meth:`pub_many` when max_msgs are buffered or the oldest has waited for linger_secs.
+        call :meth:`pub_batching_stop` to publish whatever is left
+        """
+        self.pub_batching_stop()
+        self._batch = DotDot({'max_msgs': max_msgs, 'linger_secs': linger_secs, 'continue': True})
+        self._batch_msgs = []
+        self._batch_lock = threading.Lock()
+        self._batch_error = None
+        self._batch_ts = None
+        self._batch_thread = threading.Thread(target=self._batch_linger)
+        self._batch_thread.daemon = True
+        self._batch_thread.start()
+
+    def pub_batching_stop(self):
+        """publishes buffered messages and disables batching"""
+        if self._batch is None:
+            return None
+        self._batch['continue'] = False
+        self._batch_thread.join()
+        self._batch_raise()
+        rt = self._batch_flush()     # on failure batching stays set so messages are kept for a retry
+        self._batch = None
+        return rt
+
+    def _batch_add(self, msg):
+        self._batch_raise()
+        with self._batch_lock:
+            if not self._batch_msgs:
+                self._batch_ts = time()
+            self._batch_msgs.append(msg)
+            if len(self._batch_msgs) >= self._batch.max_msgs:
+                self._batch_flush()
+
+    def _batch_flush(self):
+        """publishes buffered messages, caller must hold the lock unless batching is stopped
+        on failure messages are put back in buffer
+        """
+        msgs, self._batch_msgs = self._batch_msgs, []
+        try:
+            return self.pub_many(msgs)
+        except Exception:
+            self._batch_msgs = msgs + self._batch_msgs
+            raise
+
+    def _batch_linger(self):
+        linger_secs = self._batch.linger_secs
+        while self._batch['continue']:
+            sleep(linger_secs / 2.0)
+            with self._batch_lock:
+                if self._batch_msgs and time() - self._batch_ts >= linger_secs:
+                    try:
+                        self._batch_flush()
+                    except Exception as e:
+                        self._batch_error = e
+
+    def _batch_raise(self):
+        """raises an error of a background publish on caller's thread"""
+        if self._batch_error is not None:
+            e, self._batch_error = self._batch_error, None
+            raise e
+
     def pub_autothrottle_set(self, check_every=10000):
         """must be called explicitly after instantiation if we want to enable auto-throttle"""
         self._autothrottle = DotDot({'cnt': 0, 'check_every': check_every})
@@ -466,6 +693,97 @@ class PubSub(Sub):
         return super(PubSub, self).poll(query, projection=projection, start_from_last=start_from_last,
                                         sleep_secs=sleep_secs, filter_func=self._yield_doc, limit=limit)
 
+    def claim(self, n=100, topic=None, verb=None, target=SubTarget.NAME, projection=None, tries=3):
+        """claims up to n oldest unprocessed messages (those requesting acknowledgement)
+        by marking them as received with a single update_many and returns them fetched by a single query.
+        Competing consumers can't get same message since only messages still in SENT state are updated,
+        a random claim token tells which of them this call won, if it won none of them (an other consumer was faster)
+        it tries again on messages past those up to tries times
+
+        :Parameters: see :meth:`tail`
+            - tries: (int) maximum number of claim attempts when competing consumers got all selected messages
+        :Returns: a list of messages (possibly less than n or empty)
+
+        .. Note:: on capped collections only messages published with a reserved claim field can be claimed
+
+        if this instance has joined a consumer group (see :meth:`group_join`) only messages of its partition
+        are claimed
+        """
+        query = self._query(state=MsgState.SENT, topic=topic, verb=verb, target=target)
+        query['ackn'] = {'$ne': Acknowledge.NO}
+        if self._group is not None:
+            members_cnt, member_idx = self.group_partition()
+            if members_cnt > 1:
+                query['ts'] = {'$mod': [members_cnt, member_idx]}
+        token = Int64(random.getrandbits(63) or 1)
+        up = {'$set': {'status.state': MsgState.RECEIVED, 'dt.received': int(time()),
+                       'status.receivedBy': self._name_max, 'status.claim': token}}
+        for _ in range(max(1, tries)):
+            docs = list(self._collection.find(query, projection={'_id': 1, 'ts': 1}, sort=[('ts', 1)], limit=n))
+            if not docs:
+                return []
+            ids = [d['_id'] for d in docs]
+            if self._collection.update_many({'_id': {'$in': ids}, 'status.state': MsgState.SENT}, up).modified_count:
+                return list(self._collection.find({'_id': {'$in': ids}, 'status.claim': token},
+                                                  projection=projection, sort=[('ts', 1)]))
+            query['ts'] = dict(query.get('ts', {}), **{'$gt': docs[-1]['ts']})   # lost them all, try next ones
+        return []
+
+    def group_join(self, group, heartbeat_secs=10, member_timeout_secs=None):
+        """joins a consumer group, members of a group registered in AuxTools (for this collection) split messages
+        into partitions by ts % members count so their claims (see :meth:`claim`) don't compete.
+        partitions are rebalanced on next claims when members join or leave,
+        a member that has not refreshed its membership for member_timeout_secs is considered gone.
+        During rebalancing partitions can overlap for a while, it is safe since claims are atomic
+
+        :Parameters:
+            - group: (str) group name
+            - heartbeat_secs: (int or float) seconds between membership refreshes (defaults to 10)
+            - member_timeout_secs: (int or float) liveness window of members (defaults to max(heartbeat_secs, 1) * 3)
+        """
+        self.group_leave()
+        if member_timeout_secs is None:
+            member_timeout_secs = max(heartbeat_secs, 1) * 3
+        self._group = DotDot({'name': "pubsub_group|{}|{}".format(self._collection.full_name, group),
+                              'heartbeat_secs': heartbeat_secs, 'member_timeout_secs': member_timeout_secs,
+                              'ts': 0, 'members_cnt': 1, 'member_idx': 0})
+        return self.group_partition(refresh=True)
+
+    def group_leave(self):
+        """leaves consumer group if any so remaining members take over its partition"""
+        if self._group is not None:
+            self.aux_tools.member_remove(self._group.name, self._name)
+            self._group = None
+
+    def group_partition(self, refresh=False):
+        """refreshes membership every heartbeat_secs (or now if refresh)
+
+        :Returns: tuple (members count, index of this member)
+        """
+        group = self._group
+        if refresh or time() - group.ts >= group.heartbeat_secs:
+            self.aux_tools.member_set(group.name, self._name)
+            members = self.aux_tools.members_get(group.name, max_age_secs=group.member_timeout_secs)
+            if self._name not in members:    # clocks or a slow write, count ourselves anyway
+                members = sorted(members + [self._name])
+            group.update({'ts': time(), 'members_cnt': len(members), 'member_idx': members.index(self._name)})
+        return group.members_cnt, group.member_idx
+
+    def claim_batches(self, n=100, topic=None, verb=None, target=SubTarget.NAME, projection=None, sleep_secs=0.1):
+        """batched consume, yields lists of up to n messages claimed by :meth:`claim` until :meth:`stop` is called
+
+        :Parameters:
+            - sleep_secs: (int or float) seconds to wait when there is nothing to claim
+            - see :meth:`claim` for other parameters
+        """
+        while self._continue:
+            batch = self.claim(n, topic=topic, verb=verb, target=target, projection=projection)
+            if batch:
+                yield batch
+            else:
+                self._ackn_buffer_check()
+                sleep(sleep_secs)
+
     def _tail_adhoc(self, *args, **kwargs):
         """bypass protocol and tails as defined by parent - used for testing"""
         return super(PubSub, self).tail(*args, **kwargs)
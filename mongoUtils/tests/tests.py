@@ -8,6 +8,7 @@ import unittest
 import gzip
 import json
 import codecs
+import time
 
 from mongoUtils.client import muClient
 from mongoUtils.configuration import testDbConStr
@@ -15,12 +16,18 @@ from mongoUtils import _PATH_TO_DATA
 from mongoUtils import importsExports, mapreduce, schema, helpers
 from mongoUtils.aggregation import AggrCounts, Aggregation
 from mongoUtils.tests.PubSubBench import ps_tests
+from mongoUtils.pubsub import PubSub
 
 try:
     import xlrd
     xlrd_installed = True
 except ImportError:
     xlrd_installed = False
+try:
+    import numpy
+    numpy_installed = True
+except ImportError:
+    numpy_installed = False
 
 
 def setUpStrEr(msg):
@@ -110,6 +117,33 @@ class Test(unittest.TestCase):
         res = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_copy'],
                                 create_indexes=True, dropTarget=True, write_options={}, verbose=0)
         self.assertEqual(res.count(), self.db.muTest_tweets.count(), "error in coll_copy")
+        self.assertEqual(sorted(res.index_information().keys()), sorted(self.db.muTest_tweets.index_information().keys()),
+                         "coll_copy indexes differ")
+
+    def test_helpers_coll_copy_parallel(self):
+        res = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_copy_parallel'],
+                                dropTarget=True, write_options={}, verbose=0, workers=4, chunk_size=150)
+        self.assertEqual(res.count(), self.db.muTest_tweets.count(), "error in parallel coll_copy")
+
+    def test_helpers_coll_copy_raw(self):
+        res = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_copy_raw'],
+                                dropTarget=True, write_options={}, verbose=0, raw=True, batch_bytes=2 ** 16)
+        self.assertEqual(res.count(), self.db.muTest_tweets.count(), "error in raw coll_copy")
+        self.assertEqual(res.find_one(sort=[('_id', 1)]), self.db.muTest_tweets.find_one(sort=[('_id', 1)]),
+                         "raw coll_copy documents differ")
+
+    def test_helpers_coll_copy_resume(self):
+        """an interrupted copy resumes from its checkpoint and tolerates already copied documents"""
+        target = self.db['muTest_tweets_copy_resume']
+        helpers.coll_copy(self.db.muTest_tweets, target, dropTarget=True, write_options={}, verbose=0, checkpoint=True)
+        aux_tools = helpers.AuxTools(client=self.client)
+        cp_name = helpers._coll_copy_checkpoint_name(self.db.muTest_tweets, target)
+        mid_id = self.db.muTest_tweets.find(sort=[('_id', 1)], skip=500, limit=1)[0]['_id']
+        target.delete_many({'_id': {'$gt': mid_id}})
+        aux_tools.checkpoint_set(cp_name, done=False, last_id=self.db.muTest_tweets.find_one(sort=[('_id', 1)])['_id'])
+        res = helpers.coll_copy(self.db.muTest_tweets, target, dropTarget=True, write_options={}, verbose=0, resume=True)
+        self.assertEqual(res.count(), self.db.muTest_tweets.count(), "error in resumed coll_copy")
+        self.assertTrue(aux_tools.checkpoint_get(cp_name)['done'], "resumed coll_copy not marked as done")
 
     def test_helpers_coll_chunks(self):
         """guarantees that all documents are fetched and no overlaps occur
@@ -122,6 +156,252 @@ class Test(unittest.TestCase):
         out_lst = set(out_lst)
         self.assertEqual(len(out_lst), doc_count, "wrong coll_chunks ranges or overlaps occurred")
 
+    def test_helpers_coll_chunks_sample(self):
+        """approximate (sampled) chunk boundaries still cover all documents without overlaps"""
+        doc_count = self.db.muTest_tweets.count()
+        out_lst = []
+        for i in helpers.coll_chunks(self.db.muTest_tweets, '_id', 100, method='sample'):
+            out_lst.extend([i['_id'] for i in self.db.muTest_tweets.find(i[1], projection={})])
+        self.assertEqual(len(out_lst), doc_count, "wrong sampled coll_chunks ranges")
+        self.assertEqual(len(set(out_lst)), doc_count, "overlaps occurred in sampled coll_chunks")
+
+    def test_helpers_coll_parallel_scan(self):
+        """all documents are scanned once when chunks are processed in parallel"""
+        res = helpers.coll_parallel_scan(self.db.muTest_tweets, lambda c, q: c.find(q).count(), '_id', 90,
+                                         workers=4, merge_func=lambda x, y: x + y, merge_init=0, verbose=False)
+        self.assertEqual(res.failed, {}, "coll_parallel_scan failed chunks")
+        self.assertEqual(res.results, self.db.muTest_tweets.count(), "wrong coll_parallel_scan results")
+
+    def test_helpers_coll_transform_bulk(self):
+        coll = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_transform'], dropTarget=True,
+                                 write_options={}, verbose=0)
+
+        def func(doc, coll):
+            doc['text_len'] = len(doc['text'])
+            return doc
+        res = helpers.coll_transform(coll, func=func, verbose=False, bulk_n=100, projection=['text'])
+        self.assertEqual(res.transformed, coll.count(), "wrong coll_transform count")
+        self.assertEqual(coll.find({'text_len': {'$gt': 0}, 'user': {'$exists': True}}).count(), coll.count(),
+                         "wrong coll_transform bulk results")
+
+    def test_helpers_coll_transform_diff(self):
+        coll = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_transform_diff'], dropTarget=True,
+                                 write_options={}, verbose=0)
+
+        def func(doc, coll):
+            if doc['user']['lang'] == 'en':
+                doc['user']['lang'] = 'english'
+                del doc['text']
+            return doc
+        cnt_en = coll.find({'user.lang': 'en'}).count()
+        res = helpers.coll_transform(coll, func=func, verbose=False, bulk_n=100, diff=True)
+        self.assertEqual(res.transformed, cnt_en, "wrong coll_transform diff transformed count")
+        self.assertEqual(res.unchanged, coll.count() - cnt_en, "wrong coll_transform diff unchanged count")
+        self.assertEqual(coll.find({'user.lang': 'english', 'text': {'$exists': False}}).count(), cnt_en,
+                         "wrong coll_transform diff results")
+
+    def test_helpers_coll_transform_incremental(self):
+        coll = helpers.coll_copy(self.db.muTest_tweets, self.db['muTest_tweets_transform_inc'], dropTarget=True,
+                                 write_options={}, verbose=0)
+        helpers.AuxTools(client=self.client).checkpoint_reset("coll_transform|{}".format(coll.full_name))
+        res = helpers.coll_transform(coll, verbose=False, incremental=True, track_field='_id')
+        self.assertEqual(res.total, coll.count(), "wrong coll_transform incremental first run")
+        coll.insert_one({'text': 'new'})
+        res = helpers.coll_transform(coll, verbose=False, incremental=True, track_field='_id')
+        self.assertEqual(res.total, 1, "wrong coll_transform incremental next run")
+
+    def test_helpers_db_copy_concurrent(self):
+        self.db.drop_collections_startingwith(['del_muTest_'])
+        res = helpers.db_copy(self.db, self.db, col_name_prefix='del_', verbose=0, coll_workers=3, max_per_db=2,
+                              write_options={}, return_results=True)
+        for col_name in ['muTest_tweets', 'muTest_tweets_users']:
+            self.assertEqual(self.db['del_' + col_name].count(), self.db[col_name].count(), "error in concurrent db_copy")
+            self.assertEqual(res[col_name]['documents'], self.db[col_name].count(), "wrong db_copy results")
+            self.assertIn('seconds', res[col_name]['indexes'], "db_copy index results missing")
+
+    def test_helpers_bulk_ops_bytes(self):
+        coll = self.db['muTest_bulk_ops']
+        coll.drop()
+        bulk = helpers.muBulkOps(coll, ordered=False, ae_n=1000, ae_b=2 ** 12)
+        for i in range(100):
+            bulk.insert({'_id': i, 'text': 'x' * (i * 10)})
+            self.assertLessEqual(bulk.bytes_pending, 2 ** 12 + 1100, "muBulkOps pending bytes exceed ae_b")
+        bulk.execute_if_pending()
+        self.assertEqual(coll.count(), 100, "muBulkOps byte auto execute lost documents")
+
+    def test_helpers_bulk_ops_crud(self):
+        coll = self.db['muTest_bulk_ops_crud']
+        coll.drop()
+        bulk = helpers.muBulkOps(coll, ordered=True, ae_n=7)
+        for i in range(100):
+            bulk.upsert({'_id': i % 10}, {'$inc': {'cnt': 1}})
+        bulk.replace_one({'_id': 0}, {'cnt': -1})
+        bulk.delete_one({'_id': 1})
+        bulk.find({'_id': 2}).update_one({'$set': {'cnt': 0}})
+        bulk.execute_if_pending()
+        self.assertEqual(bulk.cnt_operations_executed, 103, "wrong muBulkOps operations count")
+        self.assertEqual(coll.count(), 9, "wrong muBulkOps upserts/deletes")
+        self.assertEqual(coll.find_one({'_id': 3})['cnt'], 10, "wrong muBulkOps updates")
+        self.assertEqual(coll.find_one({'_id': 0})['cnt'], -1, "wrong muBulkOps replace")
+
+    def test_helpers_bulk_ops_adaptive(self):
+        coll = self.db['muTest_bulk_ops_adaptive']
+        coll.drop()
+        bulk = helpers.muBulkOps(coll, ordered=False, ae_latency=0.001, ae_n_min=20, ae_n_max=500)
+        for i in range(5000):
+            bulk.insert({'_id': i})
+            self.assertTrue(20 <= bulk.ae_n <= 500, "muBulkOps adaptive ae_n out of bounds")
+        bulk.execute_if_pending()
+        self.assertEqual(coll.count(), 5000, "muBulkOps adaptive mode lost documents")
+
+    def test_helpers_bulk_ops_async(self):
+        coll = self.db['muTest_bulk_ops_async']
+        coll.drop()
+        bulk = helpers.muBulkOps(coll, ordered=False, ae_n=100, async_n=2)
+        for i in range(1000):
+            bulk.insert({'_id': i})
+        bulk.insert({'_id': 0})
+        self.assertRaises(helpers.BulkWriteError, bulk.close)
+        self.assertEqual(coll.count(), 1000, "muBulkOps async execute lost documents")
+
+    def test_helpers_bulk_ops_dead_letters(self):
+        coll = self.db['muTest_bulk_ops_dead_letters']
+        coll.drop()
+        bulk = helpers.muBulkOps(coll, ordered=False, ae_n=100, retries=2, retry_sleep=0.01, dead_letters=True)
+        for i in range(200):
+            bulk.insert({'_id': i % 150})
+        bulk.execute_if_pending()
+        self.assertEqual(coll.count(), 150, "muBulkOps partial failure lost documents")
+        self.assertEqual(len(bulk.dead_letters), 50, "muBulkOps dead letters not reported")
+        self.assertEqual(bulk.dead_letters[0][1]['code'], 11000, "wrong muBulkOps dead letter error")
+        self.assertEqual(bulk.cnt_retried, 0, "muBulkOps retried permanent failures")
+
+    def test_helpers_field_counts(self):
+        coll = self.db.muTest_tweets_users
+        counts = {}
+        for strategy in ('index', 'group', 'sortByCount', 'auto'):
+            counts[strategy] = helpers.field_counts(coll, 'lang', strategy=strategy)
+            self.assertEqual(counts[strategy][-1][1], 352, "wrong field_counts {} count".format(strategy))
+            self.assertEqual(len(counts[strategy]), len(counts['index']), "field_counts strategies differ")
+        res = helpers.field_counts(coll, 'lang', limit=2)
+        self.assertEqual(len(res), 2, "field_counts limit ignored")
+        self.assertLess(sum([i[2] for i in res]), 100.01, "wrong field_counts percentages")
+
+    @unittest.skipIf(numpy_installed is False, 'pip install numpy to test OID_gaps')
+    def test_helpers_oid_gaps(self):
+        res = helpers.OID_gaps(self.db.muTest_tweets, verbose=False)
+        self.assertEqual(res.count, self.db.muTest_tweets.count(), "OID_gaps missed documents")
+        self.assertEqual(sum([b[1] for b in res.buckets]), res.count, "wrong OID_gaps buckets")
+        res_parallel = helpers.OID_gaps(self.db.muTest_tweets, workers=2, chunk_size=300, verbose=False)
+        self.assertEqual(res_parallel.count, res.count, "parallel OID_gaps missed documents")
+        self.assertEqual(res_parallel.gaps, res.gaps, "parallel OID_gaps gaps differ")
+
+    def test_helpers_client_inventory(self):
+        res = helpers.db_counts(self.client, fast=True, cache_ttl=60)
+        self.assertEqual(res.dbs[self.db.name]['muTest_tweets'], self.db.muTest_tweets.count(),
+                         "wrong client_inventory count")
+        self.assertTrue(helpers.db_counts(self.client, fast=True, cache_ttl=60).cached, "client_inventory not cached")
+        res = self.client.cl_colstats(fast=True, verbose=False)
+        self.assertEqual(res.dbs[self.db.name]['muTest_tweets']['count'], self.db.muTest_tweets.count(),
+                         "wrong client_inventory stats")
+
+    def test_helpers_lazy_son_dot(self):
+        codec_options = helpers.CodecOptions(document_class=helpers.LazySONDot)
+        doc = self.db.muTest_tweets.with_options(codec_options=codec_options).find_one(sort=[('_id', 1)])
+        plain = self.db.muTest_tweets.find_one(sort=[('_id', 1)])
+        self.assertEqual(doc.user.screen_name, plain['user']['screen_name'], "wrong LazySONDot nested value")
+        self.assertEqual(list(doc), list(plain), "wrong LazySONDot keys")
+        self.assertEqual(helpers.BSON.encode(doc), helpers.BSON.encode(plain), "LazySONDot raw bytes differ")
+
+    def test_helpers_collection_cache(self):
+        coll = helpers.muCollection(self.db, 'muTest_tweets_users')
+        coll.cache_enable(max_size=5, oplog=False)
+        ids = [d['_id'] for d in coll.find(projection={'_id': 1}, sort=[('_id', 1)], limit=10)]
+        self.assertEqual([d['_id'] for d in coll.find_by_ids(ids)], ids, "wrong find_by_ids documents")
+        self.assertEqual(coll.find_one({'_id': ids[-1]})['_id'], ids[-1], "wrong cached find_one document")
+        self.assertIsNone(coll.find_one('no such id'), "cached find_one found missing document")
+        stats = coll.cache_stats()
+        self.assertEqual((stats.hits, stats.misses, stats.size), (1, 11, 5), "wrong collection cache counters")
+        coll.cache_disable()
+
+    def test_helpers_collection_cache_oplog(self):
+        if 'oplog.rs' not in self.client['local'].collection_names():
+            self.skipTest('oplog invalidation requires a replica set')
+        coll = helpers.muCollection(self.db, 'muTest_cache_oplog')
+        coll.drop()
+        coll.insert_one({'_id': 1, 'val': 0})
+        coll.cache_enable(oplog=True)
+        self.assertEqual(coll.find_one(1)['val'], 0, "wrong cached document")
+        self.db.muTest_cache_oplog.update_one({'_id': 1}, {'$set': {'val': 1}})
+        for i in range(50):
+            if coll.find_one(1)['val'] == 1:
+                break
+            time.sleep(0.1)
+        self.assertEqual(coll.find_one(1)['val'], 1, "cache not invalidated by oplog update")
+        self.db.drop_collection('muTest_cache_oplog')
+        for i in range(50):
+            if coll.cache_stats().size == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(coll.cache_stats().size, 0, "cache not cleared by oplog drop")
+        coll.cache_disable()
+
+    def test_helpers_aux_sequence_block(self):
+        aux_tools = helpers.AuxTools(client=self.client, block_size=100, prefetch=True)
+        aux_tools.sequence_reset('muTest_seq')
+        ids = [aux_tools.sequence_next_block('muTest_seq') for i in range(1000)]
+        self.assertEqual(ids, list(range(1, 1001)), "sequence blocks not monotonic")
+        self.assertGreater(helpers.AuxTools(client=self.client).sequence_next('muTest_seq'), 1000,
+                           "sequence block values reused")
+        aux_tools.sequence_reset('muTest_seq')
+
+    def test_pubsub_pub_many(self):
+        pubsub = PubSub('muTest_pubsub_many', db=self.db, reset=True, size=2 ** 24)
+        pubsub.pub_many([{'payload': {'cnt': i}, 'topic': 'foo'} for i in range(100)])
+        ts = [d['ts'] for d in pubsub._collection.find(sort=[('$natural', 1)])]
+        self.assertEqual(ts, list(range(ts[0], ts[0] + 100)), "pub_many ids not consecutive")
+        pubsub.pub_batching_set(max_msgs=10, linger_secs=0.05)
+        for i in range(25):
+            pubsub.pub({'cnt': i}, topic='bar')
+        pubsub.pub_batching_stop()
+        self.assertEqual(pubsub._collection.count(), 125, "batched pub lost messages")
+
+    def test_pubsub_claim(self):
+        pubsub = PubSub('muTest_pubsub_claim', db=self.db, reset=True, size=2 ** 24)
+        pubsub.pub_many([{'payload': {'cnt': i}, 'topic': 'foo'} for i in range(50)])
+        batch = pubsub.claim(20, topic='foo', target=None)
+        self.assertEqual([m['payload']['cnt'] for m in batch], list(range(20)), "wrong claimed messages")
+        self.assertEqual(set([m['status']['state'] for m in batch]), set([2]), "claimed messages not received")
+        self.assertEqual(len(pubsub.claim(100, topic='foo', target=None)), 30, "messages claimed twice")
+        self.assertEqual(pubsub.claim(100, topic='foo', target=None), [], "claimed non existing messages")
+
+    def test_pubsub_acknowledge_done_many(self):
+        pubsub = PubSub('muTest_pubsub_ackn', db=self.db, reset=True, size=2 ** 24)
+        pubsub.pub_many([{'payload': {'cnt': i}} for i in range(30)])
+        batch = pubsub.claim(30, target=None)
+        res = pubsub.acknowledge_done_many(batch[:10] + [{'_id': {'id': -1}}])
+        self.assertEqual((res.matched, len(res.unmatched)), (10, 1), "wrong acknowledge_done_many results")
+        pubsub.acknowledge_buffer_set(max_msgs=15, max_secs=60)
+        results = [pubsub.acknowledge_done_buffered(m) for m in batch[10:]]
+        self.assertEqual(results[-6][0].matched, 15, "acknowledge buffer not flushed by count")
+        self.assertEqual(pubsub.acknowledge_flush()[0].matched, 5, "wrong acknowledge buffer flush")
+        self.assertEqual(pubsub._collection.find({'status.state': 3}).count(), 30, "messages not acknowledged")
+
+    def test_pubsub_consumer_group(self):
+        producer = PubSub('muTest_pubsub_group', db=self.db, reset=True, size=2 ** 24)
+        producer.pub_many([{'payload': {'cnt': i}} for i in range(40)])
+        consumers = [PubSub('muTest_pubsub_group', db=self.db, name='consumer_' + str(i)) for i in range(2)]
+        for consumer in consumers:
+            consumer.group_join('muTest', heartbeat_secs=60)
+        partitions = [consumer.group_partition(refresh=True) for consumer in consumers]
+        self.assertEqual(sorted(partitions), [(2, 0), (2, 1)], "wrong consumer group partitions")
+        batches = [consumer.claim(100, target=None) for consumer in consumers]
+        self.assertEqual([len(b) for b in batches], [20, 20], "consumer group partitions not balanced")
+        for batch, partition in zip(batches, partitions):
+            self.assertEqual(set([m['ts'] % 2 for m in batch]), set([partition[1]]), "wrong consumer group partition")
+        for consumer in consumers:
+            consumer.group_leave()
+
     def test_pubsub(self):
         res = ps_tests('speed', testDbConStr)
         self.assertGreater(res.msgsPerSecPub, 1000, "message publishing too slow")